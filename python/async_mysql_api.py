@@ -0,0 +1,375 @@
+"""Asyncio version of mysql_api.MySQLApi, built on aiomysql.
+
+Python 3 only. Shares its generated SQL with MySQLApi, so the two produce
+identical statements.
+"""
+
+import aiomysql
+import asyncio
+import itertools
+import logging
+import time
+
+import mysql_api
+import util
+
+
+app_identity = mysql_api.LazyModule('google.appengine.api.app_identity')
+
+
+_pools = {}
+
+
+async def get_pool(credentials, **kwargs):
+    """Get or create the aiomysql pool for these credentials.
+
+    aiomysql pools belong to an event loop, so there's one per loop. Pool
+    options in kwargs only take effect when the pool is first created.
+    """
+    loop = asyncio.get_running_loop()
+    for key, future in list(_pools.items()):
+        if future.get_loop().is_closed():
+            # Nothing can use it now, and it keeps the old loop alive.
+            del _pools[key]
+    key = (id(loop), tuple(sorted(credentials.items())))
+    future = _pools.get(key, None)
+    if future is None or future.get_loop() is not loop:
+        # Store the future right away, with no await in between, so that
+        # concurrent callers wait on the same pool rather than each making one.
+        future = _pools[key] = asyncio.ensure_future(
+            aiomysql.create_pool(charset='utf8', autocommit=False,
+                                 **dict(credentials, **kwargs)))
+    try:
+        return await future
+    except Exception:
+        # Don't cache the failure; let the next caller try again.
+        if _pools.get(key, None) is future:
+            del _pools[key]
+        raise
+
+
+async def close_pools():
+    """Close every pool belonging to the running event loop."""
+    loop = asyncio.get_running_loop()
+    for key in [k for k, f in _pools.items() if f.get_loop() is loop]:
+        pool = await _pools.pop(key)
+        pool.close()
+        await pool.wait_closed()
+
+
+class AsyncMySQLApi(object):
+    """Coroutine counterpart of MySQLApi. Use `async with` so connections are
+    returned to the pool.
+
+    Example:
+
+    async with AsyncMySQLApi(**credentials) as mysql_api:
+        result = await mysql_api.select_star_where(
+            'checkpoint', status='incomplete')
+
+    Connections always come from an aiomysql pool, one per set of credentials
+    per event loop. Locally (util.is_localhost()) it connects to
+    local_ip:local_port like MySQLApi does, which is how to run it against a
+    development MySQL server.
+    """
+
+    connection = None
+    pool = None
+    # Same policy, and circuit breakers, as MySQLApi. aiomysql raises PyMySQL
+    # errors, which carry the same MySQL error codes.
+    retry_policy = mysql_api.MySQLApi.retry_policy
+    request_budget_s = None  # if set, give up retrying this long after enter
+    request_deadline = None  # unix time, set from request_budget_s
+    insert_chunk_rows = 1000  # max rows per multi-row INSERT
+    insert_chunk_bytes = 1024 * 1024  # approx max bytes per multi-row INSERT
+
+    # Same cache as MySQLApi, since the SQL is the same.
+    statement_cache = mysql_api.MySQLApi.statement_cache
+
+    # Configurable on instantiation.
+    cloud_sql_instance = None  # Cloud SQL instance name in project.
+    cloud_sql_user = 'root'
+    local_user = None
+    local_password = None
+    local_ip = '127.0.0.1'
+    local_port = 3306
+    db_name = None
+    pool_min_size = 1
+    pool_max_size = 10
+    pool_recycle_s = 300  # replace pooled connections older than this
+
+    def __init__(self, **kwargs):
+        keys = ['cloud_sql_instance', 'cloud_sql_user', 'local_user',
+                'local_password', 'local_ip', 'local_port', 'db_name',
+                'pool_min_size', 'pool_max_size', 'pool_recycle_s',
+                'request_budget_s']
+        for k in keys:
+            v = kwargs.get(k, None)
+            if v:
+                setattr(self, k, v)
+
+    async def __aenter__(self):
+        if self.request_budget_s:
+            self.request_deadline = time.time() + self.request_budget_s
+        await self.connect_to_db()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        # If the block blew up with a database error the connection may be in
+        # a bad state, so don't give it back to the pool.
+        discard = type is not None and issubclass(type, aiomysql.Error)
+        await self._release_connection(discard=discard)
+
+    async def _cursor_retry_wrapper(self, method_name, query_string,
+                                    param_tuple):
+        """Wrap cursor.execute with a retry, sleeping without blocking.
+
+        See MySQLApi._cursor_retry_wrapper().
+
+        Args:
+            method_name     str, either 'execute' or 'executemany'
+
+        Returns: the cursor the call succeeded on, which the caller must
+            close.
+        """
+        policy = self.retry_policy
+        breaker_key = self._db_key()
+        call_start = time.time()
+        tries = 0
+        while True:
+            policy.check_breaker(breaker_key)
+            cursor = None
+            try:
+                if self.connection is None:
+                    # Previous try dropped it.
+                    await self.connect_to_db()
+                cursor = await self.connection.cursor()
+                # Either execute or execute_many
+                await getattr(cursor, method_name)(query_string, param_tuple)
+                policy.record_success(breaker_key)
+                return cursor  # call succeeded, don't try again
+            except aiomysql.Error as e:
+                policy.record_failure(breaker_key, e)
+                if cursor is not None:
+                    await cursor.close()
+                if not policy.is_transient(e):
+                    raise
+                tries += 1
+                delay = policy.delay(tries, call_start, self.request_deadline)
+                if delay is None:
+                    raise
+                # Log the error and try again. Close the problematic
+                # connection; the next try makes a new one.
+                logging.error("AsyncMySQLApi caught an exception and will "
+                              "retry in {:.3f}s.".format(delay))
+                logging.error(e)
+                await self._release_connection(discard=True)
+            await asyncio.sleep(delay)
+
+    async def connect_to_db(self):
+        """Borrow a connection from the pool for these credentials."""
+        self.pool = await get_pool(
+            self._credentials(),
+            minsize=self.pool_min_size,
+            maxsize=self.pool_max_size,
+            pool_recycle=self.pool_recycle_s,
+        )
+        self.connection = await self.pool.acquire()
+
+    def _db_key(self):
+        """Identifies the database, e.g. for its circuit breaker."""
+        return (self.cloud_sql_instance, self.local_ip, self.local_port,
+                self.db_name)
+
+    def _credentials(self):
+        """Keyword arguments for aiomysql.connect() in this environment."""
+        if util.is_localhost() or util.is_codeship():
+            credentials = {
+                'host': self.local_ip,
+                'port': self.local_port,
+                'user': self.local_user,
+                'password': self.local_password or '',
+            }
+        else:
+            # Note: for second generation cloud sql instances, the instance
+            # name must include the region, e.g. 'us-central1:production-01'.
+            credentials = {
+                'unix_socket': '/cloudsql/{app_id}:{instance_name}'.format(
+                    app_id=app_identity.get_application_id(),
+                    instance_name=self.cloud_sql_instance),
+                'user': self.cloud_sql_user,
+            }
+        if self.db_name:
+            credentials['db'] = self.db_name
+        return credentials
+
+    async def _release_connection(self, discard=False):
+        """Hand the connection back to the pool, rolled back.
+
+        Args:
+            discard: bool, if True close the connection rather than let the
+                pool reuse it, e.g. because it just raised an error.
+        """
+        if self.connection is None:
+            return
+        if not discard:
+            try:
+                await self.connection.rollback()
+            except aiomysql.Error:
+                discard = True
+        if discard:
+            # The pool drops closed connections when they're released.
+            self.connection.close()
+        await self.pool.release(self.connection)
+        self.connection = None
+
+    async def _fetch(self, query_string, param_tuple, n=None):
+        """Run a query and return (cursor.description, rows)."""
+        cursor = await self._cursor_retry_wrapper(
+            'execute', query_string, param_tuple)
+        try:
+            if n is None:
+                rows = await cursor.fetchall()
+            else:
+                rows = await cursor.fetchmany(n)
+            return cursor.description, rows
+        finally:
+            await cursor.close()
+
+    async def query(self, query_string, param_tuple=tuple(), n=None):
+        """Run a general-purpose query. Returns a tuple of tuples."""
+        description, rows = await self._fetch(query_string, param_tuple, n)
+        return rows
+
+    async def select_query(self, query_string, param_tuple=tuple(), n=None):
+        """Like .query() but returns a list of dictionaries."""
+        description, rows = await self._fetch(query_string, param_tuple, n)
+        fields = [f[0] for f in description]
+        return [dict(zip(fields, row)) for row in rows]
+
+    async def select_star_where(self, table, order_by=None, limit=100,
+                                offset=None, **where_params):
+        """Get whole rows matching filters. Restricted but convenient."""
+        keys = tuple(where_params.keys())
+        values = tuple([where_params[k] for k in keys])
+        if offset:
+            values += (int(offset), int(limit))
+        else:
+            values += (int(limit),)
+
+        query = self.statement_cache.get(
+            ('select_star_where', table, keys, order_by, bool(offset)),
+            mysql_api.MySQLApi._build_select_star_where,
+            table, keys, order_by, offset,
+        )
+
+        return await self.select_query(query, values)
+
+    async def select_single_value(self, query_string, param_tuple=tuple()):
+        """Returns the first value of the first row of results, or None."""
+        description, rows = await self._fetch(query_string, param_tuple, 1)
+        return rows[0][0] if rows else None
+
+    async def _commit(self):
+        """Must be called for INSERT and UPDATE queries or they won't work.
+
+        Raises aiomysql.Error on failed commit, with automatic rollback.
+        """
+        try:
+            await self.connection.commit()
+        except aiomysql.Error as e:
+            await self.connection.rollback()
+            raise aiomysql.Error(
+                "Last query will be rolled back. {}".format(e))
+
+    async def _execute(self, query_string, param_tuple):
+        """Run a write statement. Returns the number of affected rows."""
+        cursor = await self._cursor_retry_wrapper(
+            'execute', query_string, param_tuple)
+        try:
+            return cursor.rowcount
+        finally:
+            await cursor.close()
+
+    async def insert_row_dicts(self, table, row_dicts,
+                               on_duplicate_key_update=None,
+                               chunk_rows=None, chunk_bytes=None):
+        """Insert one record or many records in one transaction.
+
+        See MySQLApi.insert_row_dicts().
+
+        Returns: list of dictionaries, one per chunk, with keys 'rows',
+            'affected', 'estimated_bytes' and 'seconds'.
+        """
+        # Standardize to list.
+        if type(row_dicts) is not list:
+            row_dicts = [row_dicts]
+
+        columns = sorted(row_dicts[0].keys())
+        num_columns = len(columns)
+        value_tuples = mysql_api._row_tuples(row_dicts, columns)
+
+        chunks = list(mysql_api.MySQLApi._chunk_rows(
+            value_tuples,
+            num_columns,
+            chunk_rows or self.insert_chunk_rows,
+            chunk_bytes or self.insert_chunk_bytes,
+        ))
+        odku = tuple(on_duplicate_key_update or ())
+
+        def statement(rows):
+            query_string = self.statement_cache.get(
+                ('insert', table, tuple(columns), len(rows), odku),
+                mysql_api.MySQLApi._build_insert_query_string,
+                table, columns, len(rows), odku,
+            )
+            return query_string, tuple(itertools.chain.from_iterable(rows))
+
+        stats = []
+        steps = mysql_api.MySQLApi._chunk_write_steps(
+            chunks, statement, False, self.retry_policy.num_tries, stats)
+        result = None
+        try:
+            while True:
+                try:
+                    action, arg = steps.send(result)
+                except StopIteration:
+                    return stats
+                result = None
+                if action == 'execute':
+                    result = (await self._execute(*arg), self.connection)
+                elif action == 'commit':
+                    await self._commit()
+                else:
+                    await self.connection.rollback()
+        except Exception:
+            # Earlier chunks are still uncommitted on this connection; roll
+            # them back so the next write doesn't commit them.
+            await self._release_connection()
+            raise
+
+    async def update_row(self, table, id_col, id, **params):
+        """UPDATE a row by id, assumed to be unique key."""
+        keys = tuple(params.keys())
+        query_string = self.statement_cache.get(
+            ('update', table, keys, id_col),
+            mysql_api.MySQLApi._build_update_row, table, keys, id_col,
+        )
+
+        p = [params[k] for k in keys]
+        p.append(id)
+
+        await self._execute(query_string, tuple(p))
+
+        await self._commit()
+
+    async def delete_row(self, table, id_col, id):
+        """DELETE a row by id, assumed to be the unique key."""
+        query_string = self.statement_cache.get(
+            ('delete', table, id_col),
+            mysql_api.MySQLApi._build_delete_row, table, id_col,
+        )
+
+        await self._execute(query_string, (id,))
+
+        await self._commit()
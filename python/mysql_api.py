@@ -1,216 +1,2858 @@
 """Convenience wrapper for MySQLdb."""
 
+import atexit
 import collections
-import google.appengine.api.app_identity as app_identity
+import contextlib
+import copy
+import hashlib
+import heapq
+import importlib
+import itertools
 import logging
-import MySQLdb
+import math
+import numbers
+import os
+import random
+import re
+import tempfile
+import threading
 import time
 
 import util
 
 
+class LazyModule(object):
+    """Stand-in for a module that's only imported when first used.
+
+    MySQLdb and the App Engine APIs are slow to import, and plenty of code
+    imports this module without ever running a query, so don't make every
+    cold start pay for them.
+    """
+
+    def __init__(self, name, submodules=()):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            for submodule in self._submodules:
+                importlib.import_module(self._name + '.' + submodule)
+            self._module = module
+        return getattr(self._module, attr)
+
+
+app_identity = LazyModule('google.appengine.api.app_identity')
+MySQLdb = LazyModule('MySQLdb', submodules=('cursors',))
+# Optional, only for select_query(result_format='arrays').
+numpy = LazyModule('numpy')
+
+
+try:
+    _string_types = (basestring, bytearray)
+    _text_type = unicode
+except NameError:
+    # Python 3
+    _string_types = (str, bytes, bytearray)
+    _text_type = str
+
+
+class PoolExhausted(Exception):
+    """Raised when no pooled connection frees up within the wait timeout."""
+    pass
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of MySQLdb connections sharing one set of credentials.
+
+    Connections are borrowed with get() and handed back with put(). Idle
+    connections older than max_idle_s are closed rather than reused, and a
+    connection that has sat idle longer than ping_after_s is pinged before
+    being handed out. At most max_size connections (idle + borrowed) exist at
+    any time; further callers wait up to wait_timeout_s for one to be returned.
+
+    Don't instantiate directly, use get_pool() so that every MySQLApi with the
+    same credentials shares one pool.
+    """
+
+    def __init__(self, credentials, max_size=10, max_idle_s=300,
+                 ping_after_s=5, reconnect_tries=2, wait_timeout_s=10):
+        self.credentials = credentials
+        self.max_size = max_size
+        self.max_idle_s = max_idle_s
+        self.ping_after_s = ping_after_s
+        self.reconnect_tries = reconnect_tries
+        self.wait_timeout_s = wait_timeout_s
+
+        self._idle = collections.deque()  # (connection, time last returned)
+        self._num_open = 0  # idle plus borrowed
+        self._changed = set()  # ids of borrowed connections, see put()
+        self._condition = threading.Condition(threading.Lock())
+
+    def _connect(self):
+        return MySQLdb.connect(charset='utf8', **self.credentials)
+
+    def _close_quietly(self, connection):
+        try:
+            connection.close()
+        except MySQLdb.Error:
+            pass
+
+    def _evict_idle(self, now):
+        """Close connections that have been idle too long. Hold the lock."""
+        # Oldest connections are on the left because put() appends.
+        while self._idle and now - self._idle[0][1] > self.max_idle_s:
+            connection, _ = self._idle.popleft()
+            self._num_open -= 1
+            self._close_quietly(connection)
+
+    def _is_alive(self, connection, idle_s):
+        """Ping only connections that have been idle a while.
+
+        A connection that was in use a moment ago is almost certainly fine, and
+        skipping the ping saves a round trip on the hot path.
+        """
+        if idle_s < self.ping_after_s:
+            return True
+        try:
+            connection.ping()
+            return True
+        except MySQLdb.Error:
+            return False
+
+    def get(self):
+        """Borrow a live connection, creating one if there's room."""
+        deadline = time.time() + self.wait_timeout_s
+        with self._condition:
+            while True:
+                now = time.time()
+                self._evict_idle(now)
+                if self._idle or self._num_open < self.max_size:
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise PoolExhausted(
+                        "All {} connections in use.".format(self.max_size))
+                self._condition.wait(remaining)
+
+            if self._idle:
+                # Most recently used connection is the warmest, take from the
+                # right.
+                connection, returned = self._idle.pop()
+            else:
+                connection, returned = None, None
+                self._num_open += 1  # reserve a slot before leaving the lock
+
+        if connection is not None:
+            if self._is_alive(connection, time.time() - returned):
+                return connection
+            logging.info("Pooled MySQL connection failed ping, replacing.")
+            self._close_quietly(connection)
+
+        # Either the pool was empty or the idle connection was dead; either way
+        # we hold a reserved slot and need a fresh connection for it.
+        tries = 0
+        while True:
+            try:
+                return self._connect()
+            except MySQLdb.Error:
+                tries += 1
+                if tries >= self.reconnect_tries:
+                    self._discard_slot()
+                    raise
+
+    def _discard_slot(self):
+        with self._condition:
+            self._num_open -= 1
+            self._condition.notify()
+
+    def session_changed(self, connection):
+        """Note that a borrowed connection's session state was changed, e.g.
+        by SET or CREATE TEMPORARY TABLE, so put() closes it.
+        """
+        with self._condition:
+            self._changed.add(id(connection))
+
+    def put(self, connection, discard=False):
+        """Return a borrowed connection.
+
+        Only the transaction is reset: any open one is rolled back. Other
+        session state, e.g. variables, temporary tables and named locks,
+        would carry over to the next borrower, so a connection marked with
+        session_changed() is closed instead of reused. So is one that fails
+        to roll back, or if `discard` is set.
+        """
+        with self._condition:
+            if id(connection) in self._changed:
+                self._changed.discard(id(connection))
+                discard = True
+        if not discard:
+            try:
+                connection.rollback()
+            except MySQLdb.Error:
+                discard = True
+
+        if discard:
+            self._close_quietly(connection)
+            self._discard_slot()
+            return
+
+        with self._condition:
+            self._idle.append((connection, time.time()))
+            self._evict_idle(time.time())
+            self._condition.notify()
+
+    def close_all(self):
+        """Close every idle connection. Borrowed ones close when returned."""
+        with self._condition:
+            while self._idle:
+                connection, _ = self._idle.pop()
+                self._num_open -= 1
+                self._close_quietly(connection)
+
+
+def _estimate_row_bytes(row):
+    """Rough size of a row of values once escaped into a query string.
+
+    Counts string lengths plus quotes and separators, and a flat allowance for
+    everything else (numbers, dates, NULL), which covers their longest
+    literals. Deliberately cheap; leave headroom below max_allowed_packet for
+    escaping and multibyte characters.
+    """
+    size = 2  # parentheses
+    for v in row:
+        if isinstance(v, _string_types):
+            size += len(v) + 4
+        else:
+            size += 28
+    return size
+
+
+def _keyset_clause(columns):
+    """SQL for "columns come after %s, %s, ..." in ascending order.
+
+    Spelled out as (a > %s) OR (a = %s AND b > %s) ..., rather than the
+    equivalent row comparison (a, b) > (%s, %s), because older versions of
+    MySQL can't use an index for the latter. Use with _keyset_params().
+    """
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = ['`{}` = %s'.format(c) for c in columns[:i]]
+        clauses.append(' AND '.join(equal + ['`{}` > %s'.format(column)]))
+    return '(({}))'.format(') OR ('.join(clauses))
+
+
+def _keyset_params(values):
+    """Parameters for _keyset_clause(), given the last row's key values."""
+    params = tuple()
+    for i in range(len(values)):
+        params += tuple(values[:i + 1])
+    return params
+
+
+_table_pattern = re.compile(
+    r'\b(?:FROM|JOIN)\s+(?:`?\w+`?\.)?`?(\w+)`?', re.IGNORECASE)
+_from_clause_pattern = re.compile(
+    r'\bFROM\b(.*?)(?:\bWHERE\b|\bGROUP\b|\bORDER\b|\bLIMIT\b|$)',
+    re.IGNORECASE | re.DOTALL)
+
+
+def _tables_in_query(query_string):
+    """Best guess at the table names a SELECT reads, for cache tagging.
+
+    Returns an empty list, meaning "don't cache", for anything with a
+    subquery or a comma join, since those can read tables this doesn't see.
+    """
+    if query_string.upper().count('SELECT') != 1:
+        return []
+    from_clause = _from_clause_pattern.search(query_string)
+    if from_clause and ',' in from_clause.group(1):
+        return []
+    return _table_pattern.findall(query_string)
+
+
+_literal_patterns = [
+    # Order matters: strings first, so digits inside them aren't touched.
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+    (re.compile(r'"(?:[^"\\]|\\.|"")*"'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%s'), '?'),
+    # Collapse lists of any length, e.g. IN (?, ?, ?) and VALUES (?),(?).
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?+)'),
+    (re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+'), '(?+)+'),
+    (re.compile(r'(?:WHEN \? THEN \? ?)+', re.IGNORECASE), 'WHEN ? THEN ? '),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+_read_pattern = re.compile(r'\s*\(?\s*(?:SELECT|SHOW)\b', re.IGNORECASE)
+_locking_read_pattern = re.compile(
+    r'\bFOR\s+(?:UPDATE|SHARE)\b|\bLOCK\s+IN\s+SHARE\s+MODE\b',
+    re.IGNORECASE)
+
+
+def _is_read(query_string):
+    """Whether a statement only reads, so it could go to a replica."""
+    return (_read_pattern.match(query_string) is not None and
+            _locking_read_pattern.search(query_string) is None)
+
+
+# Statements that leave state in the session beyond the transaction, which
+# a pooled connection mustn't pass on. See ConnectionPool.put().
+_session_state_pattern = re.compile(
+    r'(?:^|;)\s*(?:SET\b(?!\s+(?:GLOBAL|PERSIST)\b)|USE\b|LOCK\s+TABLES?\b|'
+    r'CREATE\s+TEMPORARY\b|PREPARE\b)|\bGET_LOCK\s*\(|@\w+\s*:=',
+    re.IGNORECASE)
+
+
+_hint_position_pattern = re.compile(r'^\s*\(?\s*SELECT\b(\s*/\*\+)?',
+                                    re.IGNORECASE)
+
+
+def _with_execution_time_hint(query_string, timeout_s):
+    """Add a MAX_EXECUTION_TIME optimizer hint to a SELECT, so the server
+    stops it after timeout_s. Servers before MySQL 5.7.8 ignore it.
+    """
+    hint = 'MAX_EXECUTION_TIME({})'.format(max(1, int(timeout_s * 1000)))
+    match = _hint_position_pattern.match(query_string)
+    if match is None:
+        return query_string
+    if match.group(1):
+        # A SELECT only reads its first hint comment, so join that.
+        hint = ' {}'.format(hint)
+    else:
+        hint = ' /*+ {} */'.format(hint)
+    return query_string[:match.end()] + hint + query_string[match.end():]
+
+
+_written_table_pattern = re.compile(
+    r'\s*(?:(?:INSERT|REPLACE)(?:\s+IGNORE)?\s+INTO|UPDATE(?:\s+IGNORE)?|'
+    r'DELETE\s+FROM)\s+(?:`?\w+`?\.)?`?(\w+)`?',
+    re.IGNORECASE)
+
+
+def _fingerprint(query_string):
+    """Query with literals and placeholders replaced, see QueryStats."""
+    for pattern, replacement in _literal_patterns:
+        query_string = pattern.sub(replacement, query_string)
+    return query_string.strip()
+
+
+def _percentile(sorted_samples, percent):
+    """Nearest-rank percentile of a sorted list, or None if empty."""
+    if not sorted_samples:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_samples)))
+    return sorted_samples[max(rank, 1) - 1]
+
+
+def _tsv_field(value):
+    """Encode a value as a field of LOAD DATA's default format, as bytes."""
+    if value is None:
+        return b'\\N'
+    if isinstance(value, _text_type):
+        value = value.encode('utf8')
+    elif isinstance(value, bool):
+        return b'1' if value else b'0'
+    elif isinstance(value, float):
+        # repr() keeps every digit, unlike str() on Python 2.
+        return repr(value).encode('ascii')
+    elif not isinstance(value, (bytes, bytearray)):
+        # Numbers, dates, Decimals, all have the right str() for MySQL.
+        return str(value).encode('utf8')
+    return (bytes(value).replace(b'\\', b'\\\\')
+                        .replace(b'\t', b'\\t')
+                        .replace(b'\n', b'\\n')
+                        .replace(b'\r', b'\\r')
+                        .replace(b'\0', b'\\0'))
+
+
+def _write_tsv(rows, num_columns):
+    """Write rows to a temporary file for LOAD DATA. Returns its path.
+
+    The caller must delete the file.
+    """
+    handle, path = tempfile.mkstemp(prefix='mysql_api_load_', suffix='.tsv')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            for row in rows:
+                if len(row) != num_columns:
+                    raise Exception("Expected {} values, got: {}.".format(
+                        num_columns, row))
+                f.write(b'\t'.join([_tsv_field(v) for v in row]) + b'\n')
+    except:
+        os.remove(path)
+        raise
+    return path
+
+
+def _parse_load_info(info, rowcount):
+    """Read counts from a message like "Records: 3  Deleted: 0  Skipped: 1
+    Warnings: 1", which MySQL sends after LOAD DATA.
+    """
+    counts = dict(
+        (k.lower(), int(v))
+        for k, v in re.findall(r'(\w+): (\d+)', info or '')
+    )
+    return {
+        'rows': counts.get('records', rowcount),
+        'loaded': rowcount,
+        'skipped': counts.get('skipped', 0),
+    }
+
+
+def _flatten(batches):
+    """Generate the items of each list in turn, closing `batches` when done."""
+    try:
+        for batch in batches:
+            for item in batch:
+                yield item
+    finally:
+        batches.close()
+
+
+def _pad_in_list(values, max_size):
+    """Pad a list of IN (...) values to a power of two long, at most max_size,
+    by repeating the last one.
+
+    Lists of any length then share a few statements, rather than one per
+    length, in StatementCache and the server's query stats.
+    """
+    size = 1
+    while size < len(values):
+        size *= 2
+    size = max(min(size, max_size), len(values))
+    return list(values) + [values[-1]] * (size - len(values))
+
+
+def _row_tuples(row_dicts, columns, num_fields=None):
+    """Value tuples of row dictionaries, in the order of columns.
+
+    Args:
+        row_dicts: list of dictionaries, which must all have the same keys.
+        columns: sequence of keys to take values from.
+        num_fields: int, number of keys every dictionary has, if some aren't
+            in columns. Default len(columns).
+
+    Returns: list of tuples.
+    """
+    if num_fields is None:
+        num_fields = len(columns)
+    try:
+        value_tuples = [tuple([d[c] for c in columns]) for d in row_dicts
+                        if len(d) == num_fields]
+    except KeyError:
+        value_tuples = None
+    if value_tuples is None or len(value_tuples) != len(row_dicts):
+        raise Exception("Inconsistent fields: {}.".format(row_dicts))
+    return value_tuples
+
+
+def _override_converters(default_converters, overrides):
+    """Copy of a MySQLdb converter dictionary, with overrides applied."""
+    converters = dict(default_converters)
+    for field_type, function in overrides.items():
+        if function is None:
+            # MySQLdb leaves types it has no converter for as strings.
+            converters.pop(field_type, None)
+        else:
+            converters[field_type] = function
+    return converters
+
+
+_row_classes = {}
+
+
+def _row_class(fields):
+    """namedtuple class for rows of these columns, made once per set."""
+    row_class = _row_classes.get(fields, None)
+    if row_class is None:
+        # rename replaces columns that aren't identifiers, e.g. COUNT(*),
+        # with _0, _1 etc. by position.
+        row_class = collections.namedtuple('Row', fields, rename=True)
+        _row_classes[fields] = row_class
+    return row_class
+
+
+# MySQL field type codes, from MySQLdb.constants.FIELD_TYPE.
+_integer_field_types = frozenset([
+    1,  # TINY
+    2,  # SHORT
+    3,  # LONG
+    8,  # LONGLONG
+    9,  # INT24
+    13,  # YEAR
+])
+_float_field_types = frozenset([
+    4,  # FLOAT
+    5,  # DOUBLE
+])
+
+
+def _format_rows(rows, description, result_format):
+    """Reshape a tuple of row tuples, see MySQLApi.select_query()."""
+    fields = [f[0] for f in description]
+    if result_format == 'dicts':
+        return [dict(zip(fields, row)) for row in rows]
+    if result_format == 'tuples':
+        return list(rows)
+    if result_format == 'rows':
+        return list(map(_row_class(tuple(fields))._make, rows))
+    if result_format not in ('columns', 'arrays'):
+        raise Exception("Unknown result format: {}.".format(result_format))
+
+    if rows:
+        columns = dict(zip(fields, [list(c) for c in zip(*rows)]))
+    else:
+        columns = {f: [] for f in fields}
+    if result_format == 'arrays':
+        try:
+            numpy.ndarray
+        except ImportError:
+            raise Exception("Result format 'arrays' needs numpy installed.")
+        for field in description:
+            name, type_code = field[0], field[1]
+            values = columns[name]
+            if type_code in _integer_field_types and None not in values:
+                columns[name] = numpy.array(values, dtype=numpy.int64)
+            elif (type_code in _integer_field_types or
+                    type_code in _float_field_types):
+                columns[name] = numpy.array(
+                    [numpy.nan if v is None else v for v in values],
+                    dtype=numpy.float64)
+    return columns
+
+
+def _as_text(value):
+    """Unicode text of a value, decoding bytes as utf8."""
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode('utf8', 'replace')
+    return _text_type(value)
+
+
+def _same_value(stored, given):
+    """Whether a value read from MySQL matches one about to be written.
+
+    MySQLdb hands back Decimals, datetimes and bytes where callers usually
+    write floats and strings, so compare numbers as numbers and everything
+    else by its text, e.g. datetime(2017, 1, 1) matches '2017-01-01 00:00:00'.
+    """
+    if stored is None or given is None:
+        return stored is given
+    if stored == given:
+        return True
+    if (isinstance(stored, numbers.Number) and
+            isinstance(given, numbers.Number)):
+        return float(stored) == float(given)
+    return _as_text(stored) == _as_text(given)
+
+
+def _sync_key(values):
+    """Key values in a form that matches however MySQL hands them back.
+
+    Numbers compare as numbers and everything else by its lowercased text,
+    as under MySQL's default case-insensitive collations, e.g.
+    ('ABC', '2017-01-01 00:00:00') matches (u'abc', datetime(2017, 1, 1)).
+    """
+    key = []
+    for value in values:
+        if value is None:
+            pass
+        elif isinstance(value, numbers.Integral):
+            value = int(value)
+        elif isinstance(value, numbers.Number):
+            value = float(value)
+        else:
+            value = _as_text(value).lower()
+        key.append(value)
+    return tuple(key)
+
+
+def _row_hash(values):
+    """Hex md5 of a sequence of values, telling None apart from 'None'."""
+    parts = [u'\\N' if v is None else u'v' + _as_text(v) for v in values]
+    return hashlib.md5(u'\x1f'.join(parts).encode('utf8')).hexdigest()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(credentials, **kwargs):
+    """Get or create the process-wide pool for these credentials.
+
+    Pool options in kwargs only take effect when the pool is first created.
+    """
+    key = tuple(sorted(credentials.items()))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(credentials, **kwargs)
+        return _pools[key]
+
+
+class WriteBehindFull(Exception):
+    """Raised when a WriteBehindBuffer stays full for add()'s timeout."""
+    pass
+
+
+class WriteBehindBuffer(object):
+    """Collects rows per table and inserts them from a background thread.
+
+    For high-rate, fire-and-forget writes like event logs, where a round trip
+    and a commit per row cost more than the row. Rows are inserted with
+    insert_row_dicts() in one batch per table (per set of fields) once a
+    table has max_rows waiting, or the oldest row has waited max_delay_s.
+    The thread uses its own MySQLApi, configured like the one that made the
+    buffer, and so its own connection.
+
+    * Backpressure: add() blocks while max_pending rows are unwritten, so a
+      slow database slows producers down rather than growing the buffer
+      without limit.
+    * Failures: rows can't be reported back to add(), which has returned.
+      A failed batch is split in halves and retried to isolate the bad rows,
+      and the rows that still fail are logged, passed to on_error(table,
+      rows, error) if given, and kept for failures(). If the thread itself
+      dies, everything unwritten is reported the same way.
+    * Exit: close() writes everything waiting, and buffers still open when
+      the interpreter exits are closed then.
+
+    Don't instantiate directly, use MySQLApi.write_behind() so that every
+    MySQLApi for the same database shares one buffer.
+    """
+
+    def __init__(self, api_class, config, max_rows=1000, max_delay_s=1.0,
+                 max_pending=10000, on_error=None):
+        self.api_class = api_class
+        self.config = config
+        self.max_rows = max_rows
+        self.max_delay_s = max_delay_s
+        self.max_pending = max_pending
+        self.on_error = on_error
+        self.closed = False
+
+        self._rows = {}  # table: list of row dictionaries not yet taken
+        self._oldest = None  # unix time the oldest row in _rows was added
+        self._added = 0  # rows ever added
+        self._done = 0  # rows ever written or failed
+        self._flushing = False  # write now, regardless of thresholds
+        self._failures = []  # (table, row dictionary, exception)
+        self._crash = None  # exception that killed the thread, if any
+        self._thread = None
+        self._condition = threading.Condition(threading.Lock())
+
+    def add(self, table, row_dicts, timeout_s=None):
+        """Queue one row or a list of rows to be inserted into a table.
+
+        Args:
+            timeout_s: float, optional, raise WriteBehindFull rather than
+                wait longer than this for room in the buffer.
+        """
+        if type(row_dicts) is not list:
+            row_dicts = [row_dicts]
+        deadline = None if timeout_s is None else time.time() + timeout_s
+        with self._condition:
+            # Let an oversized list in if the buffer is empty, or it never
+            # would be.
+            while (self._added - self._done + len(row_dicts) >
+                   self.max_pending and self._added > self._done):
+                self._check_open()
+                wait_s = None if deadline is None else deadline - time.time()
+                if wait_s is not None and wait_s <= 0:
+                    raise WriteBehindFull(
+                        "{} rows waiting to be written.".format(
+                            self._added - self._done))
+                self._condition.wait(wait_s)
+            self._check_open()
+
+            rows = self._rows.setdefault(table, [])
+            rows.extend(row_dicts)
+            self._added += len(row_dicts)
+            if self._oldest is None:
+                # The thread may be waiting with no timeout; start the clock.
+                self._oldest = time.time()
+                self._condition.notify_all()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='WriteBehindBuffer')
+                self._thread.daemon = True
+                self._thread.start()
+            if len(rows) >= self.max_rows:
+                self._condition.notify_all()
+
+    def _check_open(self):
+        if self._crash is not None:
+            raise Exception("WriteBehindBuffer thread died: {}".format(
+                self._crash))
+        if self.closed:
+            raise Exception("WriteBehindBuffer is closed.")
+
+    def flush(self, timeout_s=None):
+        """Write everything added so far, waiting until it's done.
+
+        Returns: bool, False if timeout_s passed first.
+        """
+        deadline = None if timeout_s is None else time.time() + timeout_s
+        with self._condition:
+            target = self._added
+            self._flushing = True
+            self._condition.notify_all()
+            while self._done < target and self._crash is None:
+                wait_s = None if deadline is None else deadline - time.time()
+                if wait_s is not None and wait_s <= 0:
+                    return False
+                self._condition.wait(wait_s)
+        return True
+
+    def close(self, timeout_s=None):
+        """Write everything waiting and stop the thread."""
+        with self._condition:
+            if self.closed:
+                return
+            self.closed = True
+            self._condition.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout_s)
+
+    def failures(self):
+        """Rows that couldn't be written since the last call, as a list of
+        (table, row dictionary, exception)."""
+        with self._condition:
+            failures = self._failures
+            self._failures = []
+        return failures
+
+    def stats(self):
+        with self._condition:
+            return {
+                'added': self._added,
+                'done': self._done,
+                'pending': self._added - self._done,
+                'failed': len(self._failures),
+            }
+
+    def _due(self):
+        if self.closed or self._flushing:
+            return True
+        if any([len(rows) >= self.max_rows for rows in self._rows.values()]):
+            return True
+        return (self._oldest is not None and
+                time.time() - self._oldest >= self.max_delay_s)
+
+    def _run(self):
+        api = self.api_class(**self.config)
+        batches = {}
+        try:
+            while True:
+                with self._condition:
+                    while not self._due():
+                        if self._oldest is None:
+                            wait_s = None
+                        else:
+                            wait_s = self._oldest + self.max_delay_s - \
+                                time.time()
+                        self._condition.wait(wait_s)
+                    batches, self._rows = self._rows, {}
+                    self._oldest = None
+                    self._flushing = False
+                    stop = self.closed
+
+                for table in list(batches.keys()):
+                    self._write(api, table, batches[table])
+                    with self._condition:
+                        self._done += len(batches.pop(table))
+                        self._condition.notify_all()
+
+                if stop:
+                    with self._condition:
+                        if not self._rows:
+                            return
+        except BaseException as e:
+            logging.error("WriteBehindBuffer thread died: {}".format(e))
+            with self._condition:
+                self._crash = e
+                for table, rows in self._rows.items():
+                    batches.setdefault(table, []).extend(rows)
+                self._rows = {}
+            for table, rows in batches.items():
+                self._fail(table, rows, e)
+                with self._condition:
+                    self._done += len(rows)
+                    self._condition.notify_all()
+        finally:
+            api._release_connection()
+
+    def _write(self, api, table, rows):
+        """Insert rows, grouped by their set of fields, isolating failures."""
+        groups = collections.OrderedDict()
+        for row in rows:
+            groups.setdefault(tuple(sorted(row.keys())), []).append(row)
+        for group in groups.values():
+            self._insert(api, table, group)
+
+    def _insert(self, api, table, rows):
+        try:
+            api.insert_row_dicts(table, rows)
+        except Exception as e:
+            down = isinstance(e, CircuitOpen) or (
+                isinstance(e, MySQLdb.Error) and
+                api.retry_policy.is_connection_error(e))
+            if len(rows) > 1 and not down:
+                # Probably some rows are bad, e.g. NULL in a NOT NULL column.
+                # Write the rest, in fresh transactions: nothing of the failed
+                # insert may be left to commit with the first half.
+                api._rollback()
+                half = len(rows) // 2
+                self._insert(api, table, rows[:half])
+                self._insert(api, table, rows[half:])
+            else:
+                self._fail(table, rows, e)
+
+    def _fail(self, table, rows, error):
+        logging.error("WriteBehindBuffer couldn't write {} rows to {}: {}"
+                      .format(len(rows), table, error))
+        with self._condition:
+            self._failures.extend([(table, row, error) for row in rows])
+        if self.on_error is not None:
+            try:
+                self.on_error(table, rows, error)
+            except Exception as e:
+                logging.error("WriteBehindBuffer on_error raised: {}"
+                              .format(e))
+
+
+_write_behinds = {}
+_write_behinds_lock = threading.Lock()
+
+
+@atexit.register
+def _close_write_behinds():
+    """Write what's waiting in every buffer before the interpreter exits."""
+    with _write_behinds_lock:
+        buffers = list(_write_behinds.values())
+    for buffer in buffers:
+        buffer.close()
+
+
+class StatementCache(object):
+    """Thread-safe LRU cache of generated SQL strings, keyed by their shape.
+
+    The write and select helpers generate their SQL from the table name,
+    column names and so on, which rarely change between calls. Caching the
+    finished string skips the formatting and joining on hot paths.
+
+    Keys must be hashable and capture everything that affects the SQL, e.g.
+    ('delete', table, id_col). Values are never in the key; they're always
+    passed as query parameters.
+    """
+
+    def __init__(self, max_size=500):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._statements = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build, *args):
+        """Cached statement for key, calling build(*args) on a miss."""
+        with self._lock:
+            statement = self._statements.pop(key, None)
+            if statement is not None:
+                self.hits += 1
+                self._statements[key] = statement  # now most recently used
+                return statement
+            self.misses += 1
+
+        statement = build(*args)
+
+        with self._lock:
+            self._statements[key] = statement
+            while len(self._statements) > self.max_size:
+                self._statements.popitem(last=False)  # least recently used
+        return statement
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._statements), 'max_size': self.max_size}
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class SchemaCache(object):
+    """Thread-safe per-process cache of table metadata.
+
+    Each entry is a dictionary like:
+
+    {
+        'columns': ['uid', 'name', ...],  # in table order
+        'types': {'uid': 'varchar(50)', ...},
+        'primary_key': ['uid'],
+        'unique_keys': {'name': ['name']},  # index name to columns
+        'loaded': 1480000000.0,  # unix time
+        'version': 3,
+    }
+
+    Entries expire after ttl_s seconds. Every invalidation bumps `version`, so
+    holders of an entry can tell if it's been superseded.
+    """
+
+    def __init__(self, ttl_s=600):
+        self.ttl_s = ttl_s
+        self.version = 0
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Cached schema for key, or None if absent or expired."""
+        with self._lock:
+            schema = self._tables.get(key, None)
+            if schema is None:
+                return None
+            if time.time() - schema['loaded'] > self.ttl_s:
+                del self._tables[key]
+                return None
+            return schema
+
+    def set(self, key, schema):
+        with self._lock:
+            schema['loaded'] = time.time()
+            schema['version'] = self.version
+            self._tables[key] = schema
+
+    def invalidate(self, keys=None):
+        """Drop the given keys, or everything if keys is None."""
+        with self._lock:
+            self.version += 1
+            if keys is None:
+                self._tables.clear()
+            else:
+                for k in keys:
+                    self._tables.pop(k, None)
+
+
+class ResultCache(object):
+    """Thread-safe LRU + TTL cache of query results, tagged by table.
+
+    Bounded both by number of entries and by the approximate size of the
+    cached results. Entries are tagged with the tables their query reads, and
+    invalidate_tables() drops every entry touching a table.
+
+    N.B. This lives in one process. Writes from other processes (or through
+    raw .query() calls) don't invalidate it, so only rely on it for rarely
+    changing data, and keep ttl_s short enough to tolerate that staleness.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=32 * 1024 * 1024,
+                 ttl_s=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # dropped to stay under max_entries or max_bytes
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()  # key: (value, tags, size,
+                                                   #       expires)
+        self._keys_by_tag = {}
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns: tuple of (bool found, cached value or None)."""
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[3] < time.time():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            # Move to the end, as most recently used.
+            del self._entries[key]
+            self._entries[key] = entry
+            return True, entry[0]
+
+    def set(self, key, value, tags, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, tags, size, time.time() + self.ttl_s)
+            self._num_bytes += size
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while (len(self._entries) > self.max_entries or
+                   self._num_bytes > self.max_bytes):
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def invalidate_tables(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def _remove(self, key):
+        """Drop an entry and its tag index. Hold the lock."""
+        value, tags, size, expires = self._entries.pop(key)
+        self._num_bytes -= size
+        for tag in tags:
+            keys = self._keys_by_tag.get(tag, None)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self._num_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_tag.clear()
+            self._num_bytes = 0
+
+
+class QueryStats(object):
+    """Thread-safe timing stats for MySQLApi, aggregated by query fingerprint.
+
+    A fingerprint is the query with literals and placeholder lists collapsed,
+    so e.g. every `SELECT * FROM user WHERE uid = 'x'` lands in one bucket.
+    Each record() call is one event, a dictionary like:
+
+    {
+        'kind': 'query',  # or 'connect', or 'convert' (rows to dictionaries)
+        'fingerprint': 'SELECT * FROM `user` WHERE `uid` = ?',
+        'seconds': 0.012,
+        'tries': 1,  # queries only
+        'rows': 1,  # rows returned or affected, if known
+        'error': None,  # or the exception, for failed queries
+        'cancelled': False,  # True if cancelled for passing its timeout
+    }
+
+    Events are also passed to every function in `sinks`, e.g. to forward
+    them to StatsD or a Prometheus histogram, and queries slower than
+    slow_query_s are logged as warnings.
+    """
+
+    max_samples = 1000  # recent timings kept per fingerprint for percentiles
+    max_fingerprints = 1000  # further fingerprints are lumped into 'other'
+
+    def __init__(self, slow_query_s=1.0, sinks=None):
+        self.slow_query_s = slow_query_s
+        self.sinks = list(sinks or [])
+        self._stats = {}
+        self._fingerprints = {}  # memoized fingerprint() results
+        self._lock = threading.Lock()
+
+    def fingerprint(self, query_string):
+        """Normalize a query so different literal values group together."""
+        fingerprint = self._fingerprints.get(query_string, None)
+        if fingerprint is None:
+            fingerprint = _fingerprint(query_string)
+            if len(self._fingerprints) >= self.max_fingerprints * 10:
+                self._fingerprints.clear()
+            self._fingerprints[query_string] = fingerprint
+        return fingerprint
+
+    def record(self, kind, query_string, seconds, tries=None, rows=None,
+               error=None, cancelled=False):
+        fingerprint = self.fingerprint(query_string) if query_string else kind
+        event = {
+            'kind': kind,
+            'fingerprint': fingerprint,
+            'seconds': seconds,
+            'tries': tries,
+            'rows': rows,
+            'error': error,
+            'cancelled': cancelled,
+        }
+
+        with self._lock:
+            key = (kind, fingerprint)
+            if key not in self._stats:
+                if len(self._stats) >= self.max_fingerprints:
+                    key = (kind, 'other')
+                if key not in self._stats:
+                    self._stats[key] = {
+                        'count': 0, 'errors': 0, 'retries': 0, 'rows': 0,
+                        'cancelled': 0, 'total_s': 0.0, 'max_s': 0.0,
+                        'samples': collections.deque(maxlen=self.max_samples),
+                    }
+            stats = self._stats[key]
+            stats['count'] += 1
+            stats['total_s'] += seconds
+            stats['max_s'] = max(stats['max_s'], seconds)
+            stats['samples'].append(seconds)
+            if error is not None:
+                stats['errors'] += 1
+            if cancelled:
+                stats['cancelled'] += 1
+            if tries:
+                stats['retries'] += tries - 1
+            if rows is not None and rows > 0:
+                stats['rows'] += rows
+
+        if kind == 'query' and seconds >= self.slow_query_s:
+            logging.warning("Slow query ({:.3f}s, {} tries): {}".format(
+                seconds, tries, ' '.join(query_string.split())))
+
+        for sink in self.sinks:
+            try:
+                sink(event)
+            except Exception as e:
+                # Stats must never break queries.
+                logging.error("QueryStats sink failed: {}".format(e))
+
+    def summary(self):
+        """Returns: list of dictionaries, one per fingerprint, slowest total
+        time first, with keys kind, fingerprint, count, errors, retries,
+        rows, cancelled, total_s, max_s, p50_s, p95_s, p99_s.
+        """
+        with self._lock:
+            items = [(k, dict(v, samples=sorted(v['samples'])))
+                     for k, v in self._stats.items()]
+        summary = []
+        for (kind, fingerprint), stats in items:
+            samples = stats.pop('samples')
+            stats.update(
+                kind=kind,
+                fingerprint=fingerprint,
+                p50_s=_percentile(samples, 50),
+                p95_s=_percentile(samples, 95),
+                p99_s=_percentile(samples, 99),
+            )
+            summary.append(stats)
+        return sorted(summary, key=lambda s: s['total_s'], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+
+class CircuitOpen(Exception):
+    """Raised without trying the database because it's recently been down."""
+    pass
+
+
+class QueryTimeout(Exception):
+    """Raised when a query is cancelled for running past its timeout."""
+    pass
+
+
+class _QueryWatchdog(object):
+    """Fires _QueryKillers at their deadlines from one thread per process,
+    rather than a timer thread per statement.
+
+    Each KILL runs on a thread of its own, since it has to connect first,
+    which may be slow; those are rare.
+    """
+
+    def __init__(self):
+        self._heap = []  # (deadline, sequence number, killer)
+        self._sequence = itertools.count()
+        self._num_stopped = 0  # killers in the heap that were stopped
+        self._condition = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def add(self, killer):
+        with self._condition:
+            killer.queued = True
+            heapq.heappush(self._heap,
+                           (killer.deadline, next(self._sequence), killer))
+            if self._thread is None or not self._thread.is_alive():
+                # First use, or we're in a forked child without the thread.
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0][2] is killer:
+                self._condition.notify()
+
+    def discard(self, killer):
+        """Forget a stopped killer, cheaply: it stays in the heap until it
+        gets to the front, or until stopped ones are most of the heap.
+        """
+        with self._condition:
+            if not killer.queued:
+                return
+            killer.queued = False
+            self._num_stopped += 1
+            if self._num_stopped > len(self._heap) // 2:
+                self._heap = [e for e in self._heap if e[2].queued]
+                heapq.heapify(self._heap)
+                self._num_stopped = 0
+
+    def _next_due(self):
+        """Wait for the next killer that's due and return it."""
+        with self._condition:
+            while True:
+                while self._heap and not self._heap[0][2].queued:
+                    heapq.heappop(self._heap)
+                    self._num_stopped -= 1
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                wait_s = self._heap[0][0] - time.time()
+                if wait_s <= 0:
+                    killer = heapq.heappop(self._heap)[2]
+                    killer.queued = False
+                    return killer
+                self._condition.wait(wait_s)
+
+    def _run(self):
+        while True:
+            thread = threading.Thread(target=self._next_due()._kill)
+            thread.daemon = True
+            thread.start()
+
+
+class _QueryKiller(object):
+    """Cancels a connection's running statement with KILL QUERY, sent from a
+    connection of its own once timeout_s has passed, unless stopped first.
+    """
+
+    connect_timeout_s = 5
+
+    def __init__(self, credentials, thread_id, timeout_s):
+        self.credentials = credentials
+        self.thread_id = thread_id
+        self.deadline = time.time() + timeout_s
+        self.killed = False
+        self.queued = False  # whether in the watchdog's heap, under its lock
+        self._stopped = False
+        self._lock = threading.Lock()
+        _query_watchdog.add(self)
+
+    def _kill(self):
+        # Hold the lock throughout, so that stop() doesn't return, and the
+        # connection can't start another statement for this to kill by
+        # mistake, until the KILL is done.
+        with self._lock:
+            if not self._stopped:
+                self.killed = self.kill_now(self.credentials, self.thread_id)
+
+    @classmethod
+    def kill_now(cls, credentials, thread_id):
+        """Send KILL QUERY for a connection's thread id right away.
+
+        Returns: bool, whether it was sent.
+        """
+        try:
+            connection = MySQLdb.connect(
+                charset='utf8', connect_timeout=cls.connect_timeout_s,
+                **credentials)
+            try:
+                connection.cursor().execute('KILL QUERY %s', (thread_id,))
+            finally:
+                connection.close()
+            return True
+        except MySQLdb.Error as e:
+            logging.error("MySQLApi couldn't cancel a query: {}".format(e))
+            return False
+
+    def stop(self):
+        """Returns: bool, whether the statement was killed."""
+        _query_watchdog.discard(self)
+        with self._lock:
+            self._stopped = True
+            return self.killed
+
+
+_query_watchdog = _QueryWatchdog()
+
+
+class RetryPolicy(object):
+    """Decides which MySQL errors to retry, and how long to wait between.
+
+    * Only transient errors are retried, identified by MySQL error code:
+      lost or failed connections, deadlocks and lock wait timeouts. Anything
+      else, e.g. a syntax error, is raised right away.
+    * Waits use "full jitter" exponential backoff, a random time between zero
+      and base_delay_s * 2 ** (tries - 1), capped at max_delay_s, so clients
+      that failed together don't retry together.
+    * A call gives up once it's used call_budget_s, or would pass the
+      caller's deadline, re-raising the last error.
+    * A circuit breaker per database opens after breaker_threshold
+      consecutive connection errors. While open, calls raise CircuitOpen
+      immediately rather than waiting on a server that's down. After
+      breaker_cooldown_s one call is let through to test it.
+
+    Subclass and override is_transient() or delay() to customize, and assign
+    an instance to MySQLApi.retry_policy.
+    """
+
+    # Codes from MySQL's errmsg.h (client, 2xxx) and mysqld_error.h (1xxx).
+    connection_error_codes = frozenset([
+        2002,  # CR_CONNECTION_ERROR, can't connect through socket
+        2003,  # CR_CONN_HOST_ERROR, can't connect to host
+        2006,  # CR_SERVER_GONE_ERROR
+        2013,  # CR_SERVER_LOST, lost connection during query
+        2055,  # CR_SERVER_LOST_EXTENDED
+    ])
+    contention_error_codes = frozenset([
+        1205,  # ER_LOCK_WAIT_TIMEOUT
+        1213,  # ER_LOCK_DEADLOCK
+    ])
+
+    def __init__(self, num_tries=4, base_delay_s=0.1, max_delay_s=2,
+                 call_budget_s=10, breaker_threshold=5, breaker_cooldown_s=10):
+        self.num_tries = num_tries
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.call_budget_s = call_budget_s
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown_s = breaker_cooldown_s
+
+        self._breakers = {}  # key: [consecutive failures, time opened]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def error_code(error):
+        """MySQL error number of a MySQLdb exception, or None."""
+        if error.args and isinstance(error.args[0], int):
+            return error.args[0]
+        return None
+
+    def is_connection_error(self, error):
+        return self.error_code(error) in self.connection_error_codes
+
+    def is_transient(self, error):
+        """Whether the same call might work if tried again."""
+        code = self.error_code(error)
+        return (code in self.connection_error_codes or
+                code in self.contention_error_codes)
+
+    def delay(self, tries, call_start, deadline=None):
+        """Seconds to wait before the next try, or None to give up.
+
+        Args:
+            tries: int, number of failed tries so far.
+            call_start: float, unix time the call started.
+            deadline: float, optional, unix time the caller needs an answer
+                by.
+        """
+        if tries >= self.num_tries:
+            return None
+        delay = random.uniform(
+            0, min(self.max_delay_s, self.base_delay_s * 2 ** (tries - 1)))
+        wake = time.time() + delay
+        if wake - call_start > self.call_budget_s:
+            return None
+        if deadline is not None and wake > deadline:
+            return None
+        return delay
+
+    def check_breaker(self, key):
+        """Raise CircuitOpen if calls to this database should fail fast."""
+        with self._lock:
+            breaker = self._breakers.get(key, None)
+            if breaker is None or breaker[1] is None:
+                return
+            if time.time() - breaker[1] < self.breaker_cooldown_s:
+                raise CircuitOpen(
+                    "MySQL has been unreachable; not trying for {}s."
+                    .format(self.breaker_cooldown_s))
+            # Cooldown over: half open. Let this call through, and restart
+            # the cooldown so concurrent calls still fail fast until it
+            # succeeds.
+            breaker[1] = time.time()
+
+    def record_success(self, key):
+        with self._lock:
+            self._breakers.pop(key, None)
+
+    def record_failure(self, key, error):
+        """Count connection errors toward opening the breaker."""
+        if not self.is_connection_error(error):
+            return
+        with self._lock:
+            breaker = self._breakers.setdefault(key, [0, None])
+            breaker[0] += 1
+            if breaker[0] >= self.breaker_threshold:
+                if breaker[1] is None:
+                    logging.error("MySQLApi circuit breaker opened after {} "
+                                  "connection errors.".format(breaker[0]))
+                breaker[1] = time.time()
+
+
+class ReplicaRouter(object):
+    """Picks a read replica for each read, and tracks which are healthy.
+
+    * strategy 'round_robin' takes turns; 'least_latency' picks the replica
+      with the lowest moving average of query time, trying unmeasured ones
+      first.
+    * A replica is evicted, i.e. skipped, for evict_s after a connection
+      error, or when a lag check finds it more than max_lag_s behind the
+      primary (or not replicating at all). Each replica's lag is checked at
+      most every lag_check_s.
+
+    Shared by all MySQLApi instances in the process, like RetryPolicy.
+    Replicas are identified by keys, see MySQLApi._replica_key().
+    """
+
+    latency_weight = 0.2  # of the latest sample in the moving average
+
+    def __init__(self, strategy='round_robin', max_lag_s=30, lag_check_s=10,
+                 evict_s=30):
+        if strategy not in ('round_robin', 'least_latency'):
+            raise Exception("Unknown replica strategy: {}.".format(strategy))
+        self.strategy = strategy
+        self.max_lag_s = max_lag_s
+        self.lag_check_s = lag_check_s
+        self.evict_s = evict_s
+
+        self._turn = 0
+        self._latency = {}  # key: moving average of seconds per read
+        self._evicted_until = {}  # key: unix time
+        self._lag_checked = {}  # key: unix time
+        self._lock = threading.Lock()
+
+    def choose(self, keys):
+        """Index of the replica to read from, or None to use the primary."""
+        now = time.time()
+        with self._lock:
+            available = [i for i, k in enumerate(keys)
+                         if self._evicted_until.get(k, 0) <= now]
+            if not available:
+                return None
+            if self.strategy == 'least_latency':
+                return min(available,
+                           key=lambda i: self._latency.get(keys[i], 0))
+            self._turn += 1
+            return available[self._turn % len(available)]
+
+    def record_latency(self, key, seconds):
+        with self._lock:
+            average = self._latency.get(key, None)
+            if average is None:
+                self._latency[key] = seconds
+            else:
+                self._latency[key] = (average * (1 - self.latency_weight) +
+                                      seconds * self.latency_weight)
+
+    def evict(self, key, reason):
+        logging.error("MySQLApi not reading from replica {} for {}s: {}"
+                      .format(key, self.evict_s, reason))
+        with self._lock:
+            self._evicted_until[key] = time.time() + self.evict_s
+            # Its latency from before may not hold when it comes back.
+            self._latency.pop(key, None)
+
+    def lag_check_due(self, key):
+        """Whether to check this replica's lag now. Claims the check, so
+        concurrent readers don't all run it."""
+        now = time.time()
+        with self._lock:
+            if now - self._lag_checked.get(key, 0) < self.lag_check_s:
+                return False
+            self._lag_checked[key] = now
+            return True
+
+    def is_lagging(self, lag_s):
+        """Whether a replica this far behind (None: not replicating) should
+        be evicted."""
+        return lag_s is None or lag_s > self.max_lag_s
+
+
+class ParallelTimeout(Exception):
+    """Raised when run_parallel() queries don't finish by the deadline."""
+    pass
+
+
 class MySQLApi(object):
     """Given credentials, connects to a Cloud SQL instance and simplifies
     various kinds of queries. Use `with` statement to ensure connections are
     correctly closed.
 
-    Example:
+    Example:
+
+    with Api(**credentials) as mysql_api:
+        result = mysql_api.select_star_where('checkpoint', status='incomplete')
+
+    N.B. Does _not_ pool/cache connections, b/c:
+
+    > We recommend that a new connection is created to service each HTTP
+    > request, and re-used for the duration of that request (since the time to
+    > create a new connection is similar to that required to test the liveness
+    > of an existing connection).
+
+    https://groups.google.com/forum/#!topic/google-cloud-sql-discuss/sS38Nh7MriY
+
+    That advice holds on App Engine, but long-lived workers that run many short
+    queries spend most of their time on the TCP + auth handshake. Those can opt
+    in with `use_pool=True`, in which case `with` borrows a connection from a
+    process-wide ConnectionPool and returns it on exit instead of closing it.
+
+    Set `lazy_connect=True` to put off connecting until the first query, for
+    code paths that may not query at all.
+
+    Reads can be spread over read replicas by listing them in `replicas`,
+    see _read(). Everything else, and every read after this instance has
+    written or while it's in a transaction, goes to the primary.
+    """
+
+    connection = None
+    cursor = None
+    pool = None  # the ConnectionPool borrowed from, if use_pool
+    transaction_depth = 0  # number of nested transaction() blocks open
+    retry_policy = RetryPolicy()  # shared by all instances
+    query_stats = QueryStats()  # shared by all instances, None to disable
+    request_budget_s = None  # if set, give up retrying this long after enter
+    request_deadline = None  # unix time, set from request_budget_s
+    lazy_connect = False  # if True, connect on first query rather than enter
+    # Default timeout for queries, in seconds; see query(). Also sets the
+    # connection's client-side read timeout.
+    query_timeout_s = None
+    # Longest per-call timeout expected, if more than query_timeout_s, so the
+    # connection's read_timeout doesn't cut those calls off. See run_parallel.
+    _read_timeout_s = None
+    query_timeout_code = 3024  # ER_QUERY_TIMEOUT, from MAX_EXECUTION_TIME
+    insert_chunk_rows = 1000  # max rows per multi-row INSERT
+    insert_chunk_bytes = 1024 * 1024  # approx max bytes per multi-row INSERT
+    in_chunk_size = 1000  # max values per IN (...) list, see select_by_keys
+
+    # Generated SQL for the helper methods, shared by all instances.
+    statement_cache = StatementCache()
+
+    # Table metadata, shared by all instances.
+    schema_cache = SchemaCache()
+
+    # Opt in to caching select_star_where() and select_single_value()
+    # results, shared by all instances. See ResultCache.
+    use_result_cache = False
+    result_cache = ResultCache()
+
+    # Which replica to read from, and which are healthy, shared by all
+    # instances. See ReplicaRouter.
+    replica_router = ReplicaRouter()
+    read_primary = False  # set on the first write, so later reads see it
+    _replica = None  # settings of the replica being read, while reading
+
+    # Configurable on instantiation.
+    cloud_sql_instance = None  # Cloud SQL instance name in project.
+    cloud_sql_user = 'root'
+    local_user = None
+    local_password = None
+    local_ip = '127.0.0.1'
+    local_port = 3306
+    db_name = None
+    use_pool = False
+    pool_max_size = 10
+    pool_max_idle_s = 300  # close pooled connections idle longer than this
+    pool_ping_after_s = 5  # ping pooled connections idle longer than this
+    pool_reconnect_tries = 2
+    pool_wait_timeout_s = 10
+    # Opt in to reading from replicas: a list of dictionaries, each
+    # overriding the settings above for one replica, e.g.
+    # [{'cloud_sql_instance': 'us-central1:production-01-replica'}] or, when
+    # local, [{'local_ip': '10.0.0.12'}].
+    replicas = None
+
+    config_keys = ['cloud_sql_instance', 'cloud_sql_user', 'local_user',
+                   'local_password', 'local_ip', 'local_port', 'db_name',
+                   'use_pool', 'pool_max_size', 'pool_max_idle_s',
+                   'pool_ping_after_s', 'pool_reconnect_tries',
+                   'pool_wait_timeout_s', 'use_result_cache',
+                   'request_budget_s', 'lazy_connect', 'replicas',
+                   'query_timeout_s']
+
+    def __init__(self, **kwargs):
+        for k in self.config_keys:
+            v = kwargs.get(k, None)
+            if v:
+                setattr(self, k, v)
+        # Replica key: (connection, cursor, pool), see _read().
+        self._replica_connections = {}
+
+    def config(self):
+        """Keyword arguments to make another instance configured like this."""
+        return {k: getattr(self, k) for k in self.config_keys}
+
+    def __enter__(self):
+        if self.request_budget_s:
+            self.request_deadline = time.time() + self.request_budget_s
+        self.read_primary = False
+        if not self.lazy_connect:
+            self.connect_to_db()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # If the block blew up with a database error the connection may be in
+        # a bad state, so don't give it back to the pool.
+        discard = type is not None and issubclass(type, MySQLdb.Error)
+        self._release_replicas(discard=discard)
+        if self.connection is None:
+            return  # lazy, and never used
+        self._release_connection(discard=discard)
+
+    def _cursor_retry_wrapper(self, method_name, query_string, param_tuple,
+                              cursorclass=None, converters=None,
+                              timeout_s=None):
+        """Wrap the normal cursor.execute from MySQLdb with a retry.
+
+        Transient errors are retried on a new connection according to
+        self.retry_policy; other errors, and transient errors once the policy
+        gives up, are re-raised as they are.
+
+        Args:
+            method_name     str, either 'execute' or 'executemany'
+            cursorclass     optional MySQLdb cursor class; if given, a fresh
+                            cursor of this class is opened on each try instead
+                            of using self.cursor.
+            converters      optional dictionary of MySQL field type to
+                            function, or None for no conversion, overriding
+                            the connection's converters for this call; see
+                            query(). Buffered cursors only, since unbuffered
+                            ones convert as rows are fetched.
+            timeout_s       optional float, cancel the call and raise
+                            QueryTimeout after this long, retries included;
+                            see query(). Defaults to query_timeout_s, except
+                            with a cursorclass, i.e. when streaming.
+
+        Returns: the cursor the call succeeded on.
+        """
+        policy = self.retry_policy
+        if timeout_s is None and cursorclass is None:
+            timeout_s = self.query_timeout_s
+        sent_query = query_string
+        deadline = self.request_deadline
+        use_hint = use_killer = False
+        if timeout_s:
+            if (method_name == 'execute' and _is_read(query_string) and
+                    _hint_position_pattern.match(query_string)):
+                use_hint = True
+            else:
+                # Writes, and reads the hint doesn't apply to, e.g. SHOW.
+                use_killer = True
+            deadline = min([d for d in (deadline, time.time() + timeout_s)
+                            if d is not None])
+        if self._replica is None:
+            breaker_key = self._db_key()
+            if (self.replicas and not self.read_primary and
+                    not _is_read(query_string)):
+                # Replicas may not have this write yet, so read our own
+                # writes from here on.
+                self.read_primary = True
+        else:
+            breaker_key = self._replica_key(self._replica)
+        changes_session = _session_state_pattern.search(query_string)
+        call_start = time.time()
+        tries = 0
+        while True:
+            policy.check_breaker(breaker_key)
+            cursor = None
+            killed = False
+            try:
+                if self.connection is None:
+                    # Previous try dropped it.
+                    self.connect_to_db()
+                if changes_session and self.pool is not None:
+                    self.pool.session_changed(self.connection)
+                if cursorclass is None:
+                    cursor = self.cursor
+                else:
+                    cursor = self.connection.cursor(cursorclass)
+                if use_hint:
+                    # Retries only get what's left of the time.
+                    sent_query = _with_execution_time_hint(
+                        query_string, max(deadline - time.time(), 0))
+                killer = None
+                if use_killer:
+                    killer = _QueryKiller(self._credentials(self._replica),
+                                          self.connection.thread_id(),
+                                          max(deadline - time.time(), 0))
+                try:
+                    self._execute_cursor(cursor, method_name, sent_query,
+                                         param_tuple, converters)
+                finally:
+                    killed = killer is not None and killer.stop()
+                policy.record_success(breaker_key)
+                self._record_stats('query', query_string, call_start,
+                                   tries=tries + 1, rows=cursor.rowcount)
+                return cursor  # call succeeded, don't try again
+            except MySQLdb.Error as e:
+                policy.record_failure(breaker_key, e)
+                if cursor is not None and cursor is not self.cursor:
+                    self._close_cursor(cursor)
+                tries += 1
+                if timeout_s and (
+                        killed or
+                        policy.error_code(e) == self.query_timeout_code or
+                        (policy.is_connection_error(e) and
+                         time.time() >= deadline)):
+                    # Cancelled by the server, by KILL QUERY, or by the
+                    # client's read timeout. Don't try again.
+                    self._record_stats('query', query_string, call_start,
+                                       tries=tries, error=e, cancelled=True)
+                    raise QueryTimeout("Query cancelled after {}s: {}".format(
+                        timeout_s, e))
+                if self.transaction_depth or not policy.is_transient(e):
+                    # In a transaction, reconnecting would silently drop every
+                    # write made so far, so let transaction() roll back and
+                    # the caller decide whether to start over.
+                    delay = None
+                else:
+                    delay = policy.delay(tries, call_start, deadline)
+                if delay is None:
+                    self._record_stats('query', query_string, call_start,
+                                       tries=tries, error=e)
+                    raise
+                # Log the error and try again. Close the problematic
+                # connection; the next try makes a new one.
+                logging.error("MySQLApi caught an exception and will retry "
+                              "in {:.3f}s.".format(delay))
+                logging.error(e)
+                self._release_connection(discard=True)
+            time.sleep(delay)
+
+    def _execute_cursor(self, cursor, method_name, query_string, param_tuple,
+                        converters=None):
+        """cursor.execute() or executemany(), see _cursor_retry_wrapper()."""
+        if converters is None:
+            getattr(cursor, method_name)(query_string, param_tuple)
+            return
+        # A buffered cursor converts every row during execute, with the
+        # converters the connection has at the time.
+        default_converters = self.connection.converter
+        self.connection.converter = _override_converters(
+            default_converters, converters)
+        try:
+            getattr(cursor, method_name)(query_string, param_tuple)
+        finally:
+            self.connection.converter = default_converters
+
+    def _cursor_execute(self, query_string, param_tuple):
+        self._cursor_retry_wrapper('execute', query_string, param_tuple)
+
+    def _cursor_executemany(self, query_string, param_tuples):
+        self._cursor_retry_wrapper('executemany', query_string, param_tuples)
+
+    def connect_to_db(self):
+        """Establish connection to MySQL db instance.
+
+        Either Google Cloud SQL or local MySQL server. Detects environment with
+        functions from util module. If `use_pool` is set, borrows from the
+        shared pool for these credentials rather than opening a new connection.
+        """
+        start = time.time()
+        credentials = self._credentials(self._replica)
+        read_timeout_s = self._read_timeout_s or self.query_timeout_s
+        if read_timeout_s:
+            # A backstop for when the server can't stop the query itself,
+            # e.g. it's gone away. The second is slack for the server to
+            # respond to MAX_EXECUTION_TIME or KILL QUERY first. Only here,
+            # where query_timeout_s applies, not on side connections.
+            # N.B. needs MySQLdb 1.2.5 or later.
+            credentials['read_timeout'] = int(math.ceil(read_timeout_s)) + 1
+
+        if self.use_pool:
+            self.pool = get_pool(
+                credentials,
+                max_size=self.pool_max_size,
+                max_idle_s=self.pool_max_idle_s,
+                ping_after_s=self.pool_ping_after_s,
+                reconnect_tries=self.pool_reconnect_tries,
+                wait_timeout_s=self.pool_wait_timeout_s,
+            )
+            self.connection = self.pool.get()
+        else:
+            # Although the docs say you can specify a `cursorclass` keyword
+            # here as an easy way to get dictionaries out instead of lists,
+            # that only works in version 1.2.5, and App Engine only has
+            # 1.2.4b4 installed as of 2015-03-30. Don't use it unless you know
+            # the production library has been updated.
+            # tl;dr: the following not allowed!
+            # self.connection = MySQLdb.connect(
+            #     charset='utf8', cursorclass=MySQLdb.cursors.DictCursor,
+            #     **creds)
+            self.connection = MySQLdb.connect(charset='utf8', **credentials)
+        self.cursor = self.connection.cursor()
+        self._record_stats('connect', None, start)
+
+    def _record_stats(self, kind, query_string, start, **kwargs):
+        """Send an event to query_stats, if enabled. See QueryStats."""
+        if self.query_stats is not None:
+            self.query_stats.record(kind, query_string, time.time() - start,
+                                    **kwargs)
+
+    def _credentials(self, replica=None):
+        """Keyword arguments for MySQLdb.connect() in this environment.
+
+        Args:
+            replica: dictionary, optional, settings to override for a
+                replica, see `replicas`.
+        """
+        settings = dict(self.config(), **(replica or {}))
+        if util.is_localhost() or util.is_codeship():
+            credentials = {
+                'host': settings['local_ip'],
+                'port': settings['local_port'],
+                'user': settings['local_user'],
+                'passwd': settings['local_password']
+            }
+        else:
+            # Note: for second generation cloud sql instances, the instance
+            # name must include the region, e.g. 'us-central1:production-01'.
+            credentials = {
+                'unix_socket': '/cloudsql/{app_id}:{instance_name}'.format(
+                    app_id=app_identity.get_application_id(),
+                    instance_name=settings['cloud_sql_instance']),
+                'user': settings['cloud_sql_user'],
+            }
+        if settings['db_name']:
+            credentials['db'] = settings['db_name']
+        return credentials
+
+    def _release_connection(self, discard=False):
+        """Close the connection, or hand it back to the pool if pooling.
+
+        Args:
+            discard: bool, if True a pooled connection is closed rather than
+                reused, e.g. because it just raised an error.
+        """
+        if self.connection is None:
+            return
+        if self.cursor is not None:
+            self._close_cursor(self.cursor)
+        if self.pool is not None:
+            self.pool.put(self.connection, discard=discard)
+        else:
+            try:
+                self.connection.close()
+            except MySQLdb.Error:
+                pass  # already broken
+        self.connection = None
+        self.cursor = None
+
+    def _close_cursor(self, cursor):
+        try:
+            cursor.close()
+        except MySQLdb.Error:
+            pass
+
+    def _swap_connection(self, state):
+        """Set (connection, cursor, pool), returning the ones replaced."""
+        previous = (self.connection, self.cursor, self.pool)
+        self.connection, self.cursor, self.pool = state
+        return previous
+
+    @staticmethod
+    def _replica_key(replica):
+        return tuple(sorted(replica.items()))
+
+    def _read(self, fetch, query_string, *args):
+        """Run fetch(query_string, *args) on a replica, if appropriate.
+
+        Only if replicas are configured, and the query is a plain SELECT (or
+        SHOW) outside a transaction, and this instance hasn't written yet;
+        otherwise it runs on the primary. replica_router picks the replica.
+        Each replica gets its own connection, made on first use and closed
+        on exit.
+
+        If the replica's lag is due a check and it's too far behind, or it
+        can't be reached, it's evicted and the read goes to the primary.
+        """
+        if (not self.replicas or self._replica is not None or
+                self.read_primary or self.transaction_depth or
+                not _is_read(query_string)):
+            return fetch(query_string, *args)
+
+        router = self.replica_router
+        keys = [self._replica_key(r) for r in self.replicas]
+        index = router.choose(keys)
+        if index is None:
+            return fetch(query_string, *args)  # all evicted
+
+        key = keys[index]
+        self._replica = self.replicas[index]
+        primary = self._swap_connection(
+            self._replica_connections.get(key, (None, None, None)))
+        try:
+            lag_s = self._replica_lag() if router.lag_check_due(key) else 0
+            if router.is_lagging(lag_s):
+                router.evict(key, "{}s behind the primary".format(lag_s))
+            else:
+                start = time.time()
+                result = fetch(query_string, *args)
+                router.record_latency(key, time.time() - start)
+                return result
+        except (MySQLdb.Error, CircuitOpen) as e:
+            if (isinstance(e, MySQLdb.Error) and
+                    not self.retry_policy.is_connection_error(e)):
+                raise
+            router.evict(key, e)
+            self._release_connection(discard=True)
+        finally:
+            self._replica = None
+            self._replica_connections[key] = self._swap_connection(primary)
+        return fetch(query_string, *args)
+
+    def _replica_lag(self):
+        """Seconds the replica being read is behind, None if not
+        replicating."""
+        # MySQL 8.0.22 renamed SLAVE to REPLICA, and 8.4 dropped the old name.
+        for statement, column in (
+                ('SHOW REPLICA STATUS', 'Seconds_Behind_Source'),
+                ('SHOW SLAVE STATUS', 'Seconds_Behind_Master')):
+            try:
+                self._cursor_execute(statement, tuple())
+            except MySQLdb.Error as e:
+                if self.retry_policy.is_connection_error(e):
+                    raise
+                last_error = e
+                continue
+            row = self.cursor.fetchone()
+            if row is None:
+                return None
+            fields = [f[0] for f in self.cursor.description]
+            return row[fields.index(column)]
+        # E.g. missing the REPLICATION CLIENT privilege. Can't tell, so
+        # trust the replica.
+        logging.error("MySQLApi couldn't check replica lag: {}"
+                      .format(last_error))
+        return 0
+
+    def _release_replicas(self, discard=False):
+        """Close replica connections, or return them to their pools."""
+        for key, state in self._replica_connections.items():
+            primary = self._swap_connection(state)
+            try:
+                self._release_connection(discard=discard)
+            finally:
+                self._swap_connection(primary)
+        self._replica_connections.clear()
+
+    def table_columns(self, table):
+        """List of column names of a table, in order. Cached.
+
+        A copy, so changing it doesn't change the cache.
+        """
+        return list(self._table_schema(table)['columns'])
+
+    def table_schema(self, table):
+        """Column names, types, and unique keys of a table. Cached.
+
+        See SchemaCache for the format. A copy, so changing it doesn't change
+        the cache.
+        """
+        return copy.deepcopy(self._table_schema(table))
+
+    def _table_schema(self, table):
+        """The cached schema itself, see table_schema(). Don't change it."""
+        key = self._schema_cache_key(table)
+        schema = self.schema_cache.get(key)
+        if schema is None:
+            schema = self._load_schemas(table).get(table, None)
+            if schema is None:
+                raise Exception("Table not found: {}.".format(table))
+        return schema
+
+    def preload_schema(self):
+        """Cache the schema of every table in db_name with two queries.
+
+        Call at worker startup to avoid a query per table later.
+
+        Returns: list of table names loaded.
+        """
+        return sorted(self._load_schemas().keys())
+
+    def invalidate_schema(self, tables=None):
+        """Forget cached schemas, e.g. after ALTER TABLE. Default: all."""
+        if tables is None:
+            self.schema_cache.invalidate()
+        else:
+            self.schema_cache.invalidate(
+                [self._schema_cache_key(t) for t in tables])
+
+    def _schema_cache_key(self, table):
+        return self._db_key() + (table,)
+
+    def _db_key(self):
+        """Identifies the database, so one process can cache several."""
+        return (self.cloud_sql_instance, self.local_ip, self.local_port,
+                self.db_name)
+
+    def _load_schemas(self, table=None):
+        """Query information_schema and cache the results.
+
+        Args:
+            table: str, optional, load only this table, otherwise all tables
+                in the database.
+
+        Returns: dictionary of table name to schema.
+        """
+        if self.db_name:
+            where = 'TABLE_SCHEMA = %s'
+            params = (self.db_name,)
+        else:
+            where = 'TABLE_SCHEMA = DATABASE()'
+            params = tuple()
+        if table is not None:
+            where += ' AND TABLE_NAME = %s'
+            params += (table,)
+
+        schemas = collections.OrderedDict()
+        column_rows = self.query("""
+            SELECT `TABLE_NAME`, `COLUMN_NAME`, `COLUMN_TYPE`
+            FROM `information_schema`.`COLUMNS`
+            WHERE {}
+            ORDER BY `TABLE_NAME`, `ORDINAL_POSITION`
+        """.format(where), params)
+        for t, column, column_type in column_rows:
+            if t not in schemas:
+                schemas[t] = {'columns': [], 'types': {}, 'primary_key': [],
+                              'unique_keys': collections.OrderedDict()}
+            schemas[t]['columns'].append(column)
+            schemas[t]['types'][column] = column_type
+
+        index_rows = self.query("""
+            SELECT `TABLE_NAME`, `INDEX_NAME`, `COLUMN_NAME`
+            FROM `information_schema`.`STATISTICS`
+            WHERE {} AND `NON_UNIQUE` = 0
+            ORDER BY `TABLE_NAME`, `INDEX_NAME`, `SEQ_IN_INDEX`
+        """.format(where), params)
+        for t, index_name, column in index_rows:
+            if t not in schemas:
+                continue
+            if index_name == 'PRIMARY':
+                schemas[t]['primary_key'].append(column)
+            else:
+                schemas[t]['unique_keys'].setdefault(index_name, [])
+                schemas[t]['unique_keys'][index_name].append(column)
+
+        for t, schema in schemas.items():
+            self.schema_cache.set(self._schema_cache_key(t), schema)
+
+        return schemas
+
+    def reset(self, table_definitions):
+        """Drop all given tables and re-created them.
+
+        Takes a dictionary of table name to with CREATE TABLE query string.
+        """
+        if not util.is_development():
+            raise Exception("You REALLY don't want to do that.")
+
+        for table, definition in table_definitions.items():
+            self.query('DROP TABLE IF EXISTS `{}`;'.format(table))
+            self.query(definition)
+
+        self.invalidate_schema(table_definitions.keys())
+        self._invalidate_results(table_definitions.keys())
+
+    def query(self, query_string, param_tuple=tuple(), n=None,
+              converters=None, timeout=None):
+        """Run a general-purpose query. Returns a tuple of tuples.
+
+        SELECTs may be read from a replica, see _read().
+
+        Args:
+            converters: dictionary, optional, MySQL field type to function
+                to convert values of that type, overriding MySQLdb's for this
+                call. None instead of a function leaves values as the string
+                MySQL sent, which is much cheaper than e.g. building datetimes
+                that are never used:
+
+                from MySQLdb.constants import FIELD_TYPE
+                mysql_api.query(query_string, converters={
+                    FIELD_TYPE.DATETIME: None, FIELD_TYPE.NEWDECIMAL: float})
+            timeout: float, optional, seconds after which to give up and
+                raise QueryTimeout, default query_timeout_s. The server stops
+                a SELECT itself, via a MAX_EXECUTION_TIME hint (MySQL 5.7.8+);
+                any other statement is cancelled with KILL QUERY from a
+                second connection. Either way it counts as cancelled in
+                query_stats. N.B. the connection's read timeout, from
+                query_timeout_s, may cut off longer timeouts than that.
+        """
+        return self._read(self._query, query_string, param_tuple, n,
+                          converters, timeout)
+
+    def _query(self, query_string, param_tuple, n, converters=None,
+               timeout=None):
+        self._cursor_retry_wrapper('execute', query_string, param_tuple,
+                                   converters=converters, timeout_s=timeout)
+        if n is None:
+            return self.cursor.fetchall()
+        else:
+            return self.cursor.fetchmany(n)
+
+    def select_query(self, query_string, param_tuple=tuple(), n=None,
+                     result_format='dicts', converters=None, timeout=None):
+        """Simple extension of .query() by making results more convenient.
+
+        Interpolate with %s syntax and the param_tuple argument. Example:
+        sql_api.query(
+            "SELECT * FROM heroes WHERE name = %s AND age = %s",
+            ('Hector', 20)
+        )
+
+        Args:
+            result_format: str, one of
+                'dicts' (default): list of dictionaries.
+                'tuples': list of tuples, as from query(), the cheapest.
+                'rows': list of namedtuples, with attributes named after the
+                    columns. Much lighter than dictionaries, and the class is
+                    made once per set of columns.
+                'columns': dictionary of column name to list of values.
+                'arrays': like 'columns', but integer and floating point
+                    columns are NumPy arrays, with NULL as NaN. DECIMAL
+                    columns stay lists, to keep their precision. Needs numpy.
+            converters, timeout: see query().
+        """
+        return self._read(self._select_query, query_string, param_tuple, n,
+                          result_format, converters, timeout)
+
+    def _select_query(self, query_string, param_tuple, n,
+                      result_format='dicts', converters=None, timeout=None):
+        result = self._query(query_string, param_tuple, n, converters,
+                             timeout)
+
+        # Results come back as a tuple of tuples. Discover the names of the
+        # SELECTed columns and reshape them as asked.
+        start = time.time()
+        rows = _format_rows(result, self.cursor.description, result_format)
+        self._record_stats('convert', query_string, start, rows=len(result))
+        return rows
+
+    def _iter_batches(self, query_string, param_tuple, batch_size,
+                      as_dicts, header=False):
+        """Generate lists of at most batch_size rows from an unbuffered cursor.
+
+        See iter_query().
+        """
+        cursor = self._cursor_retry_wrapper(
+            'execute', query_string, param_tuple,
+            cursorclass=MySQLdb.cursors.SSCursor)
+        connection, replica = self.connection, self._replica
+        try:
+            fields = [f[0] for f in cursor.description]
+            if header:
+                yield [tuple(fields)]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                if as_dicts:
+                    rows = [dict(zip(fields, row)) for row in rows]
+                yield rows
+        except GeneratorExit:
+            # The consumer stopped early, and the generator was closed or
+            # garbage collected. Closing the cursor would make the client
+            # read, and throw away, every row the server has left, maybe
+            # millions, so stop the query on the server first.
+            _QueryKiller.kill_now(self._credentials(replica),
+                                  connection.thread_id())
+            raise
+        finally:
+            # Reads what's left of the result, if anything, which frees the
+            # connection for other queries.
+            self._close_cursor(cursor)
+
+    def iter_query(self, query_string, param_tuple=tuple(), batch_size=1000,
+                   batches=False, header=False):
+        """Like .query() but streams rows rather than loading them all.
+
+        Uses a server-side (unbuffered) cursor and fetches batch_size rows at
+        a time, so memory is bounded by the batch size rather than the size of
+        the result set. Good for exporting big tables.
+
+        Only the initial execute is retried; an error partway through the
+        stream is raised to the caller, since rows have already been yielded.
+        Don't run other queries on this MySQLApi until the iterator is
+        exhausted or closed; MySQL won't allow it while rows are unread.
+
+        Args:
+            batch_size: int, rows fetched from the server per round trip.
+            batches: bool, if True yield lists of up to batch_size rows rather
+                than individual rows.
+            header: bool, if True the first row yielded is a tuple of the
+                column names (in batches mode, in a list of its own).
+
+        Returns: generator of tuples (or lists of tuples).
+        """
+        gen = self._iter_batches(query_string, param_tuple, batch_size, False,
+                                 header=header)
+        return gen if batches else _flatten(gen)
+
+    def iter_select(self, query_string, param_tuple=tuple(), batch_size=1000,
+                    batches=False):
+        """Like .select_query() but streams rows; see iter_query().
+
+        Returns: generator of dictionaries (or lists of dictionaries).
+        """
+        gen = self._iter_batches(query_string, param_tuple, batch_size, True)
+        return gen if batches else _flatten(gen)
+
+    def select_star_where(self, table, order_by=None, limit=100, offset=None,
+                          timeout=None, **where_params):
+        """Get whole rows matching filters. Restricted but convenient.
+
+        A list or tuple value matches any of its values, with IN (...). If
+        there are more than in_chunk_size of them they're split over several
+        queries, see select_by_keys(), whose rows are merged, sorted by
+        order_by and cut to `limit`; offset can't be used then.
+
+        See query() for timeout.
+        """
+        if any([isinstance(v, (list, tuple)) for v in where_params.values()]):
+            return self._select_in_chunks(table, where_params, order_by,
+                                          limit, offset, timeout=timeout)
+
+        keys = tuple(where_params.keys())
+        values = tuple([where_params[k] for k in keys])
+        if offset:
+            values += (int(offset), int(limit))
+        else:
+            values += (int(limit),)
+
+        query = self.statement_cache.get(
+            ('select_star_where', table, keys, order_by, bool(offset)),
+            self._build_select_star_where, table, keys, order_by, offset,
+        )
+
+        return self._cached_read(
+            query, values, [table],
+            lambda q, p: self.select_query(q, p, timeout=timeout),
+            copy_rows=True)
+
+    @staticmethod
+    def _build_select_star_where(table, keys, order_by, offset,
+                                 in_sizes=None, has_limit=True):
+        """SQL for select_star_where().
+
+        Args:
+            in_sizes: list, optional, for each key either None for = %s, or
+                the number of values for IN (%s, ...).
+            has_limit: bool, whether to end with a LIMIT clause.
+        """
+        where_clauses = []
+        for i, k in enumerate(keys):
+            size = in_sizes[i] if in_sizes else None
+            if size is None:
+                where_clauses.append('`{}` = %s'.format(k))
+            else:
+                where_clauses.append('`{}` IN ({})'.format(
+                    k, ', '.join(['%s'] * size)))
+        if not where_clauses:
+            where_clauses = ['1']
+
+        if not has_limit:
+            limit = ''
+        else:
+            limit = 'LIMIT %s, %s' if offset else 'LIMIT %s'
+
+        return """
+            SELECT *
+            FROM `{table}`
+            WHERE {where}
+            {order_by}
+            {limit}
+        """.format(
+            table=table,
+            where=' AND '.join(where_clauses),
+            order_by='ORDER BY `{}`'.format(order_by) if order_by else '',
+            limit=limit,
+        )
+
+    def select_by_keys(self, table, col, keys, as_dict=False, max_workers=1,
+                       timeout=None):
+        """Get whole rows by a list of values of one column, e.g. ids.
+
+        Rather than a query per key, keys go in IN (...) lists of at most
+        in_chunk_size values (and roughly insert_chunk_bytes, to stay under
+        max_allowed_packet), so 500 ids take one round trip, not 500.
+
+        Example:
+
+        users = mysql_api.select_by_keys('user', 'uid', user_uids,
+                                         as_dict=True)
+
+        Args:
+            table: str name of the table
+            col: str, column to look keys up in.
+            keys: list of values of col. Duplicates are ignored.
+            as_dict: bool, return a dictionary of row by col value, rather
+                than a list of rows. Raises if col isn't unique among the
+                rows found. Keys with no row are left out.
+            max_workers: int, if more than 1 and there's more than one IN
+                list, run the queries at the same time on that many extra
+                connections, see run_parallel().
+            timeout: float, optional, per query; see query().
+
+        Returns: list of dictionaries, in no particular order, or a
+            dictionary of them if as_dict.
+        """
+        rows = self._select_in_chunks(table, {col: list(keys)}, None, None,
+                                      None, max_workers, timeout)
+        if not as_dict:
+            return rows
+
+        by_key = {}
+        for row in rows:
+            if row[col] in by_key:
+                raise Exception("More than one row in {} with {} = {}."
+                                .format(table, col, row[col]))
+            by_key[row[col]] = row
+        return by_key
+
+    def _select_in_chunks(self, table, where_params, order_by, limit, offset,
+                          max_workers=1, timeout=None):
+        """select_star_where() with list values, as chunked IN (...) lists.
+
+        Only the longest list is split across queries; others must fit in
+        one.
+        """
+        keys = tuple(sorted(where_params.keys()))
+        lists = [k for k in keys if isinstance(where_params[k], (list, tuple))]
+        if not all([where_params[k] for k in lists]):
+            return []  # IN () matches nothing
+        split_key = max(lists, key=lambda k: len(where_params[k]))
+        for k in lists:
+            if k != split_key and len(where_params[k]) > self.in_chunk_size:
+                raise Exception("Only one list can have more than {} values."
+                                .format(self.in_chunk_size))
+
+        # Dedupe, or a row could be found by more than one chunk.
+        split_values = list(collections.OrderedDict.fromkeys(
+            where_params[split_key]))
+        chunks = list(self._chunk_rows(
+            ((v,) for v in split_values), 1, self.in_chunk_size,
+            self.insert_chunk_bytes))
+        if len(chunks) > 1 and offset:
+            raise Exception("Can't use offset with more than {} values."
+                            .format(self.in_chunk_size))
+
+        statements = []
+        for chunk, size in chunks:
+            params = dict(where_params)
+            params[split_key] = [row[0] for row in chunk]
+            values = []
+            in_sizes = []
+            for k in keys:
+                if k in lists:
+                    padded = _pad_in_list(params[k], self.in_chunk_size)
+                    values.extend(padded)
+                    in_sizes.append(len(padded))
+                else:
+                    values.append(params[k])
+                    in_sizes.append(None)
+            if offset:
+                values += [int(offset), int(limit)]
+            elif limit is not None:
+                values.append(int(limit))
+            query = self.statement_cache.get(
+                ('select_star_where', table, keys, order_by, bool(offset),
+                 tuple(in_sizes), limit is not None),
+                self._build_select_star_where, table, keys, order_by, offset,
+                in_sizes, limit is not None,
+            )
+            statements.append((query, tuple(values)))
+
+        if max_workers > 1 and len(statements) > 1:
+            results = self.run_parallel(
+                [('select_query', s, {'timeout': timeout})
+                 for s in statements],
+                max_workers=max_workers)['results']
+        else:
+            results = [
+                self._cached_read(
+                    q, p, [table],
+                    lambda q, p: self.select_query(q, p, timeout=timeout),
+                    copy_rows=True)
+                for q, p in statements
+            ]
+
+        rows = list(itertools.chain.from_iterable(results))
+        if len(statements) > 1:
+            if order_by:
+                # MySQL sorts NULL first.
+                rows.sort(key=lambda r: (r[order_by] is not None,
+                                         r[order_by]))
+            if limit is not None:
+                rows = rows[:limit]
+        return rows
+
+    def iter_star_where(self, table, order_by, page_size=100, max_rows=None,
+                        after=None, **where_params):
+        """Walk whole rows matching filters, a page at a time, by key.
+
+        Unlike select_star_where() with an offset, which makes MySQL read and
+        discard every skipped row, each page here picks up where the last left
+        off with WHERE key > last_seen, so every page costs the same.
+
+        Example:
+
+        for rows, token in mysql_api.iter_star_where(
+                'checkpoint', 'uid', status='incomplete'):
+            process(rows)
+            save_progress(token)  # resume later with after=token
+
+        Args:
+            table: str name of the table
+            order_by: str column name or tuple of them, ascending, which must
+                be unique together and should be indexed, e.g. the primary
+                key.
+            page_size: int, rows per page.
+            max_rows: int, optional, stop after this many rows in total.
+            after: tuple of order_by values, optional, the token from a
+                previous page to resume after.
+            where_params: equality filters, as in select_star_where().
+
+        Returns: generator of (list of row dictionaries, token) pairs, where
+            token is a tuple of the order_by values of the last row.
+        """
+        if not isinstance(order_by, (tuple, list)):
+            order_by = (order_by,)
+        order_by = tuple(order_by)
+        keys = tuple(where_params.keys())
+        filter_values = tuple([where_params[k] for k in keys])
+
+        num_rows = 0
+        while max_rows is None or num_rows < max_rows:
+            limit = page_size
+            if max_rows is not None:
+                limit = min(page_size, max_rows - num_rows)
+
+            query = self.statement_cache.get(
+                ('iter_star_where', table, keys, order_by, after is not None),
+                self._build_iter_star_where, table, keys, order_by,
+                after is not None,
+            )
+            values = filter_values
+            if after is not None:
+                values += _keyset_params(after)
+            values += (limit,)
+
+            rows = self.select_query(query, values)
+            if not rows:
+                break
+            num_rows += len(rows)
+            after = tuple([rows[-1][c] for c in order_by])
+            yield rows, after
+            if len(rows) < limit:
+                break  # that was the last page
+
+    @staticmethod
+    def _build_iter_star_where(table, keys, order_by, has_after):
+        where_clauses = ['`{}` = %s'.format(k) for k in keys]
+        if has_after:
+            where_clauses.append(_keyset_clause(order_by))
+
+        return """
+            SELECT *
+            FROM `{table}`
+            WHERE {where}
+            ORDER BY {order_by}
+            LIMIT %s
+        """.format(
+            table=table,
+            where=' AND '.join(where_clauses) or '1',
+            order_by=', '.join(['`{}`'.format(c) for c in order_by]),
+        )
+
+    def run_parallel(self, specs, max_workers=4, timeout_s=None,
+                     raise_errors=True):
+        """Run independent queries at the same time, one connection each.
 
-    with Api(**credentials) as mysql_api:
-        result = mysql_api.select_star_where('checkpoint', status='incomplete')
+        Each worker thread opens its own connection (from the pool, if
+        use_pool is set) configured like this instance, and takes specs in
+        turn until none are left. Queries don't see uncommitted writes made
+        on this instance, e.g. inside a transaction().
 
-    N.B. Does _not_ pool/cache connections, b/c:
+        Example:
 
-    > We recommend that a new connection is created to service each HTTP
-    > request, and re-used for the duration of that request (since the time to
-    > create a new connection is similar to that required to test the liveness
-    > of an existing connection).
+        result = mysql_api.run_parallel([
+            ('select_star_where', ('team',), {'uid': team_uid}),
+            ('select_query', ('SELECT COUNT(*) AS n FROM `user`',)),
+        ])
+        team_rows, count_rows = result['results']
 
-    https://groups.google.com/forum/#!topic/google-cloud-sql-discuss/sS38Nh7MriY
-    """
+        Args:
+            specs: list of tuples (method name, args tuple) or (method name,
+                args tuple, kwargs dictionary), naming any MySQLApi method.
+            max_workers: int, most threads (and connections) to use.
+            timeout_s: float, optional, raise ParallelTimeout if not all
+                queries have finished after this many seconds. Queries
+                already running are left to finish in the background, but no
+                more are started.
+            raise_errors: bool, default True, raise the error of the first
+                failed spec, in input order, after all have run. If False,
+                errors are returned instead.
 
-    connection = None
-    cursor = None
-    num_tries = 4
-    retry_interval_ms = 500  # base for exponential backoff: 500, 1000, 2000...
+        Returns: dictionary with keys
+            'results': list of return values, in the same order as specs,
+                None where a query failed.
+            'errors': list of exceptions, or None where a query succeeded.
+            'query_seconds': list of the time each query took.
+            'wall_seconds': float, elapsed time of the whole call.
+            'total_query_seconds': float, sum of query_seconds, to compare
+                with wall_seconds.
+        """
+        start = time.time()
+        num_specs = len(specs)
+        results = [None] * num_specs
+        errors = [None] * num_specs
+        query_seconds = [0.0] * num_specs
+        next_index = [0]  # list so workers can update it
+        lock = threading.Lock()
+        cancelled = threading.Event()
+        config = self.config()
 
-    # Configurable on instantiation.
-    cloud_sql_instance = None  # Cloud SQL instance name in project.
-    cloud_sql_user = 'root'
-    local_user = None
-    local_password = None
-    local_ip = '127.0.0.1'
-    local_port = 3306
-    db_name = None
+        read_primary = self.read_primary
+        request_deadline = self.request_deadline
+        # Per-call timeouts in the specs may be longer than query_timeout_s.
+        spec_timeouts = [s[2].get('timeout') for s in specs
+                         if len(s) > 2 and s[2].get('timeout')]
+        read_timeout_s = self.query_timeout_s and max(
+            [self.query_timeout_s] + spec_timeouts)
 
-    def __init__(self, **kwargs):
-        keys = ['cloud_sql_instance', 'cloud_sql_user', 'local_user',
-                'local_password', 'local_ip', 'local_port', 'db_name']
-        for k in keys:
-            v = kwargs.get(k, None)
-            if v:
-                setattr(self, k, v)
+        def work():
+            mysql_api = type(self)(**config)
+            # Read our own writes on the workers too.
+            mysql_api.read_primary = read_primary
+            # And retry within what's left of this request's budget.
+            mysql_api.request_deadline = request_deadline
+            mysql_api._read_timeout_s = read_timeout_s
+            try:
+                mysql_api.connect_to_db()
+                connect_error = None
+            except Exception as e:
+                # Report it as the error of every spec this worker takes.
+                connect_error = e
 
-    def __enter__(self):
-        self.connect_to_db()
-        return self
+            while not cancelled.is_set():
+                with lock:
+                    i = next_index[0]
+                    next_index[0] += 1
+                if i >= num_specs:
+                    break
+                if connect_error is not None:
+                    errors[i] = connect_error
+                    continue
+                method_name, args = specs[i][0], specs[i][1]
+                kwargs = specs[i][2] if len(specs[i]) > 2 else {}
+                query_start = time.time()
+                try:
+                    results[i] = getattr(mysql_api, method_name)(
+                        *args, **kwargs)
+                except Exception as e:
+                    errors[i] = e
+                query_seconds[i] = time.time() - query_start
 
-    def __exit__(self, type, value, traceback):
-        self.connection.close()
+            mysql_api._release_replicas()
+            if connect_error is None:
+                mysql_api._release_connection()
 
-    def _cursor_retry_wrapper(self, method_name, query_string, param_tuple):
-        """Wrap the normal cursor.execute from MySQLdb with a retry.
+        threads = [threading.Thread(target=work)
+                   for _ in range(min(max_workers, num_specs))]
+        for t in threads:
+            # Don't let a stuck query keep the process alive.
+            t.daemon = True
+            t.start()
+        for t in threads:
+            if timeout_s is None:
+                t.join()
+            else:
+                t.join(max(0, start + timeout_s - time.time()))
+        if any(t.is_alive() for t in threads):
+            cancelled.set()
+            raise ParallelTimeout(
+                "Parallel queries not done after {}s.".format(timeout_s))
+
+        if raise_errors:
+            for e in errors:
+                if e is not None:
+                    raise e
+
+        return {
+            'results': results,
+            'errors': errors,
+            'query_seconds': query_seconds,
+            'wall_seconds': time.time() - start,
+            'total_query_seconds': sum(query_seconds),
+        }
+
+    def select_single_value(self, query_string, param_tuple=tuple(),
+                            timeout=None):
+        """Returns the first value of the first row of results, or None.
+
+        See query() for timeout.
+        """
+        return self._cached_read(
+            query_string, param_tuple, _tables_in_query(query_string),
+            lambda q, p: self._select_single_value(q, p, timeout))
+
+    def _select_single_value(self, query_string, param_tuple, timeout=None):
+        return self._read(self._fetch_single_value, query_string, param_tuple,
+                          timeout)
+
+    def _fetch_single_value(self, query_string, param_tuple, timeout=None):
+        self._cursor_retry_wrapper('execute', query_string, param_tuple,
+                                   timeout_s=timeout)
+        result = self.cursor.fetchone()
+
+        # result is None if no rows returned, else a tuple.
+        return result if result is None else result[0]
+
+    def run_pipeline(self, statements, as_dicts=False):
+        """Run several statements in one round trip to the server.
+
+        The statements are sent together as one multi-statement query, which
+        MySQLdb allows by default (it connects with the CLIENT.MULTI_STATEMENTS
+        and MULTI_RESULTS flags), and the result sets are read back in turn.
+        The server runs them in order on this connection, as if by separate
+        query() calls, and stops at the first one to fail.
+
+        If any statement writes, the pipeline is committed at the end, like
+        the write helpers (or with the transaction() block it's in); if one
+        fails, the ones before it are rolled back. A transient error, e.g. a
+        deadlock, retries the whole pipeline as retry_policy allows. A
+        pipeline of only SELECTs may run on a replica, see _read().
+
+        Example:
+
+        team, count = mysql_api.run_pipeline([
+            ('UPDATE `team` SET `num_users` = %s WHERE `uid` = %s', (n, uid)),
+            ('SELECT * FROM `team` WHERE `uid` = %s', (uid,)),
+            'SELECT COUNT(*) FROM `team`',
+        ], as_dicts=True)[1:]
 
         Args:
-            method_name     str, either 'execute' or 'executemany'
+            statements: list of query strings, or of (query_string,
+                param_tuple) pairs. As with query(), write a literal % as %%.
+            as_dicts: bool, return rows as dictionaries, like select_query().
+
+        Returns: list with an item per statement, its rows (a tuple of tuples,
+            or list of dictionaries) if it returns columns, otherwise its
+            number of affected rows.
         """
+        queries = []
+        param_tuple = tuple()
+        for statement in statements:
+            if isinstance(statement, _string_types):
+                statement = (statement, tuple())
+            query_string, params = statement
+            queries.append(query_string.strip().rstrip(';'))
+            param_tuple += tuple(params)
+        query_string = ';\n'.join(queries)
+
+        written = [q for q in queries if not _is_read(q)]
+        if not written:
+            return self._read(self._fetch_pipeline, query_string, param_tuple,
+                              len(queries), as_dicts)
+
+        if self.replicas:
+            self.read_primary = True
+        results = self._fetch_pipeline(query_string, param_tuple,
+                                       len(queries), as_dicts)
+        self._commit()
+        self._invalidate_results(
+            [m.group(1) for m in map(_written_table_pattern.match, written)
+             if m])
+        return results
+
+    def _fetch_pipeline(self, query_string, param_tuple, num_statements,
+                        as_dicts):
+        """Send a multi-statement query and read each result set in turn."""
+        policy = self.retry_policy
+        call_start = time.time()
         tries = 0
-        exceptions = (MySQLdb.ProgrammingError, MySQLdb.OperationalError,
-                      MySQLdb.InterfaceError)
         while True:
+            # Errors in the first statement are retried in here; later ones
+            # only show up as the results are read, below.
+            cursor = self._cursor_retry_wrapper(
+                'execute', query_string, param_tuple)
+            results = []
             try:
-                # Either execute or execute_many
-                getattr(self.cursor, method_name)(query_string, param_tuple)
-                break  # call succeeded, don't try again
-            except exceptions as e:
-                # Log the error and try again. Close the problematic connection
-                # and make a new one.
-                logging.error("MySQLApi caught an exception and will retry.")
+                while True:
+                    if cursor.description is None:
+                        results.append(cursor.rowcount)
+                    else:
+                        rows = cursor.fetchall()
+                        if as_dicts:
+                            fields = [f[0] for f in cursor.description]
+                            rows = [dict(zip(fields, row)) for row in rows]
+                        results.append(rows)
+                    if not cursor.nextset():
+                        break
+            except MySQLdb.Error as e:
+                tries += 1
+                if self.transaction_depth or not policy.is_transient(e):
+                    # transaction() rolls back, and decides about retrying.
+                    delay = None
+                else:
+                    delay = policy.delay(tries, call_start,
+                                         self.request_deadline)
+                if not self.transaction_depth:
+                    # Don't leave earlier statements for the next commit.
+                    try:
+                        self.connection.rollback()
+                    except MySQLdb.Error:
+                        self._release_connection(discard=True)
+                if delay is None:
+                    raise
+                logging.error("MySQLApi pipeline statement {} failed, will "
+                              "retry in {:.3f}s.".format(len(results) + 1,
+                                                         delay))
                 logging.error(e)
-                self.connection.close()
-                self.connect_to_db()
-            tries += 1
-            if tries >= self.num_tries:
-                # That's enough tries, just throw an error.
-                raise Exception("Recurrent MySQLdb.ProgrammingError, gave up.")
-            # Sleep interval between tries backs off exponentially.
-            # N.B. retry interval is in ms while time.sleep() takes seconds.
-            time.sleep(2 ** (tries - 1) * self.retry_interval_ms / 1000)
-
-    def _cursor_execute(self, query_string, param_tuple):
-        self._cursor_retry_wrapper('execute', query_string, param_tuple)
+                time.sleep(delay)
+                continue
+            if len(results) != num_statements:
+                raise Exception("Expected {} results from pipeline, got {}."
+                                .format(num_statements, len(results)))
+            return results
 
-    def _cursor_executemany(self, query_string, param_tuple):
-        self._cursor_retry_wrapper('executemany', *args)
+    def _cached_read(self, query_string, param_tuple, tables, fetch,
+                     copy_rows=False):
+        """Call fetch(query_string, param_tuple) through the result cache.
 
-    def connect_to_db(self):
-        """Establish connection to MySQL db instance.
+        Goes straight to fetch() if use_result_cache is off, if the tables
+        read aren't known, or if the parameters can't be hashed. Also inside
+        a transaction, or once read_primary is set, since the rows may be
+        this connection's own uncommitted or not yet replicated writes.
 
-        Either Google Cloud SQL or local MySQL server. Detects environment with
-        functions from util module.
+        Args:
+            tables: list of table names the query reads, for invalidation.
+            fetch: function to run the query on a miss.
+            copy_rows: bool, result is a list of dictionaries, which are
+                copied on the way out so callers can't alter cached rows.
         """
-        if util.is_localhost() or util.is_codeship():
-            credentials = {
-                'host': self.local_ip,
-                'port': self.local_port,
-                'user': self.local_user,
-                'passwd': self.local_password
-            }
-        else:
-            # Note: for second generation cloud sql instances, the instance
-            # name must include the region, e.g. 'us-central1:production-01'.
-            credentials = {
-                'unix_socket': '/cloudsql/{app_id}:{instance_name}'.format(
-                    app_id=app_identity.get_application_id(),
-                    instance_name=self.cloud_sql_instance),
-                'user': self.cloud_sql_user,
-            }
-        if self.db_name:
-            credentials['db'] = self.db_name
-
-        # Although the docs say you can specify a `cursorclass` keyword
-        # here as an easy way to get dictionaries out instead of lists, that
-        # only works in version 1.2.5, and App Engine only has 1.2.4b4
-        # installed as of 2015-03-30. Don't use it unless you know the
-        # production library has been updated.
-        # tl;dr: the following not allowed!
-        # self.connection = MySQLdb.connect(
-        #     charset='utf8', cursorclass=MySQLdb.cursors.DictCursor, **creds)
-        self.connection = MySQLdb.connect(charset='utf8', **credentials)
-        self.cursor = self.connection.cursor()
+        if (not self.use_result_cache or not tables or
+                self.transaction_depth or self.read_primary):
+            return fetch(query_string, param_tuple)
 
-    def table_columns(self, table):
-        result = self.query("SHOW columns FROM `{}`".format(table))
-        return [column[0] for column in result]
-
-    def reset(self, table_definitions):
-        """Drop all given tables and re-created them.
-
-        Takes a dictionary of table name to with CREATE TABLE query string.
-        """
-        if not util.is_development():
-            raise Exception("You REALLY don't want to do that.")
+        key = (self._db_key(), ' '.join(query_string.split()),
+               tuple(param_tuple))
+        try:
+            found, result = self.result_cache.get(key)
+        except TypeError:
+            # Unhashable parameters, e.g. a list.
+            return fetch(query_string, param_tuple)
 
-        for table, definition in table_definitions.items():
-            self.query('DROP TABLE IF EXISTS `{}`;'.format(table))
-            self.query(definition)
+        if not found:
+            result = fetch(query_string, param_tuple)
+            if copy_rows:
+                size = sum([_estimate_row_bytes(r.values()) for r in result])
+            else:
+                size = _estimate_row_bytes((result,))
+            tags = [self._db_key() + (t,) for t in tables]
+            self.result_cache.set(key, result, tags, size)
 
-    def query(self, query_string, param_tuple=tuple(), n=None):
-        """Run a general-purpose query. Returns a tuple of tuples."""
-        self._cursor_execute(query_string, param_tuple)
-        if n is None:
-            return self.cursor.fetchall()
-        else:
-            return self.cursor.fetchmany(n)
+        if copy_rows:
+            return [dict(r) for r in result]
+        return result
 
-    def select_query(self, query_string, param_tuple=tuple(), n=None):
-        """Simple extension of .query() by making results more convenient.
+    def _invalidate_results(self, tables):
+        """Drop cached results that read any of these tables.
 
-        Interpolate with %s syntax and the param_tuple argument. Example:
-        sql_api.query(
-            "SELECT * FROM heroes WHERE name = %s AND age = %s",
-            ('Hector', 20)
-        )
+        Done whether or not this instance uses the cache, since the cache is
+        shared with instances that do.
         """
-        result = self.query(query_string, param_tuple, n)
+        self.result_cache.invalidate_tables(
+            [self._db_key() + (t,) for t in tables])
+        if self.transaction_depth:
+            # Other threads could re-cache the old rows before we commit,
+            # so invalidate again once the transaction is over.
+            self._pending_invalidations.update(tables)
 
-        # Results come back as a tuple of tuples. Discover the names of the
-        # SELECTed columns and turn it into a list of dictionaries.
-        fields = [f[0] for f in self.cursor.description]
-        return [{fields[i]: v for i, v in enumerate(row)} for row in result]
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group writes into one transaction with a single commit.
 
-    def select_star_where(self, table, order_by=None, limit=100, offset=None,
-                          **where_params):
-        """Get whole rows matching filters. Restricted but convenient."""
-
-        if where_params:
-            items = where_params.items()
-            keys = [k for k, v in items]
-            values = tuple([v for k, v in items])
-            where_clauses = ['`{}` = %s'.format(k) for k in keys]
-        else:
-            values = tuple()
-            where_clauses = ['1']
+        Write helpers called inside the block don't commit; everything is
+        committed together when the outermost block exits, or rolled back if
+        it raises. Nested blocks use savepoints, so an exception caught
+        inside an outer block only undoes the inner block's writes.
 
-        query = """
-            SELECT *
-            FROM `{table}`
-            WHERE {where}
-            {order_by}
-            LIMIT {offset}{limit}
-        """.format(
-            table=table,
-            where=' AND '.join(where_clauses),
-            order_by='ORDER BY `{}`'.format(order_by) if order_by else '',
-            offset='{},'.format(offset) if offset else '',
-            limit=limit,
-        )
+        Errors inside a transaction are raised rather than retried on a new
+        connection, since reconnecting would lose the earlier writes.
 
-        return self.select_query(query, values)
+        Example:
 
-    def select_single_value(self, query_string, param_tuple=tuple()):
-        """Returns the first value of the first row of results, or None."""
-        self._cursor_execute(query_string, param_tuple)
-        result = self.cursor.fetchone()
+        with mysql_api.transaction():
+            mysql_api.insert_row_dicts('user', user)
+            mysql_api.update_row('team', 'uid', team_uid, num_users=n)
+        """
+        depth = self.transaction_depth
+        if depth == 0:
+            self._pending_invalidations = set()
+        else:
+            savepoint = 'transaction_{}'.format(depth)
+            self._cursor_execute('SAVEPOINT `{}`'.format(savepoint), tuple())
+        self.transaction_depth += 1
 
-        # result is None if no rows returned, else a tuple.
-        return result if result is None else result[0]
+        try:
+            yield self
+        except:
+            self.transaction_depth -= 1
+            try:
+                if depth == 0:
+                    if self.connection is not None:
+                        self.connection.rollback()
+                else:
+                    self._cursor_execute(
+                        'ROLLBACK TO SAVEPOINT `{}`'.format(savepoint),
+                        tuple())
+            except MySQLdb.Error as e:
+                # Probably the connection is gone, which rolls back anyway.
+                # The original exception is more interesting.
+                logging.error("MySQLApi couldn't roll back: {}".format(e))
+            if depth == 0:
+                self._invalidate_results(self._pending_invalidations)
+            raise
+        else:
+            self.transaction_depth -= 1
+            if depth == 0:
+                try:
+                    self._commit()
+                finally:
+                    self._invalidate_results(self._pending_invalidations)
+            else:
+                self._cursor_execute(
+                    'RELEASE SAVEPOINT `{}`'.format(savepoint), tuple())
+
+    def _rollback(self):
+        """Roll back any open transaction, or drop the connection if that
+        fails, which rolls back anyway.
+        """
+        if self.connection is None:
+            return
+        try:
+            self.connection.rollback()
+        except MySQLdb.Error as e:
+            logging.error("MySQLApi couldn't roll back: {}".format(e))
+            self._release_connection(discard=True)
 
     def _commit(self):
         """Must be called for INSERT and UPDATE queries or they won't work.
 
+        Does nothing inside a transaction() block, which commits at the end.
+
         Raises MySQLdb.Error on failed commit, with automatic rollback.
         """
+        if self.transaction_depth or self.connection is None:
+            return
         try:
             self.connection.commit()
         except MySQLdb.Error as e:
@@ -219,48 +2861,147 @@ class MySQLApi(object):
             self.connection.rollback()
             raise MySQLdb.Error("Last query will be rolled back. {}".format(e))
 
+    def write_behind(self, **kwargs):
+        """The process-wide WriteBehindBuffer for this database.
+
+        Buffer options in kwargs (max_rows, max_delay_s, max_pending,
+        on_error) only take effect when the buffer is first created.
+        """
+        key = tuple(sorted(self._credentials().items()))
+        with _write_behinds_lock:
+            buffer = _write_behinds.get(key, None)
+            if buffer is None or buffer.closed:
+                # Nobody waits on the background writes, so don't cancel
+                # them, or cut them off with a read_timeout.
+                config = dict(self.config(), query_timeout_s=None)
+                buffer = WriteBehindBuffer(type(self), config, **kwargs)
+                _write_behinds[key] = buffer
+            return buffer
+
+    def buffer_row_dicts(self, table, row_dicts, timeout_s=None):
+        """Insert rows soon, from a background thread, and return right away.
+
+        Like insert_row_dicts() for high-rate writes where the caller doesn't
+        need to know the rows are written, e.g. logging events. Rows are
+        batched with others from every MySQLApi for this database; see
+        WriteBehindBuffer. Errors surface later, in
+        write_behind().failures(), not here. Blocks if the buffer is full.
+
+        Args:
+            table: str name of the table
+            row_dicts: a single dictionary or a list of them
+            timeout_s: float, optional, most seconds to wait for room in the
+                buffer before raising WriteBehindFull.
+        """
+        self.write_behind().add(table, row_dicts, timeout_s=timeout_s)
+
     def insert_row_dicts(self, table, row_dicts,
-                         on_duplicate_key_update=None):
+                         on_duplicate_key_update=None, **kwargs):
         """Insert one record or many records.
 
+        Thin adapter over insert_rows(), which is faster if you already have
+        your data as tuples or columns.
+
         Args:
             table: str name of the table
             row_dicts: a single dictionary or a list of them
             on_duplicate_key_update: tuple of the fields to update in the
                 existing row if there's a duplicate key error.
+            kwargs: chunk_rows, chunk_bytes, commit_each_chunk; see
+                insert_rows().
 
-        Returns: True on success and an error message string on error.
+        Returns: list of dictionaries, one per chunk; see insert_rows().
         """
         # Standardize to list.
         if type(row_dicts) is not list:
             row_dicts = [row_dicts]
 
-        # Turn each row dictionary into an ordered dictionary
-        ordered_rows = [collections.OrderedDict(
-            sorted(d.items(), key=lambda t: t[0])) for d in row_dicts]
+        # Every dictionary must have the same set of keys, which become the
+        # columns in a stable order.
+        columns = sorted(row_dicts[0].keys())
+        value_tuples = _row_tuples(row_dicts, columns)
+
+        return self.insert_rows(
+            table, columns, value_tuples,
+            on_duplicate_key_update=on_duplicate_key_update, **kwargs)
+
+    def insert_rows(self, table, columns, rows, on_duplicate_key_update=None,
+                    chunk_rows=None, chunk_bytes=None,
+                    commit_each_chunk=False):
+        """Insert rows given as tuples or columns, without per-row dicts.
 
-        # Make sure each dictionary has the same set of keys.
-        correct_keys = ordered_rows[0].keys()
-        if not all([row.keys() == correct_keys for row in ordered_rows]):
-            raise Exception("Inconsistent fields: {}.".format(ordered_rows))
+        Rows are sent as multi-row INSERT ... VALUES (...),(...) statements,
+        split into chunks so no single statement exceeds chunk_rows rows or
+        roughly chunk_bytes bytes (keep that well under the server's
+        max_allowed_packet).
 
+        Example:
+
+        mysql_api.insert_rows('heroes', ('name', 'age'),
+                              [('Hector', 20), ('Achilles', 19)])
+        mysql_api.insert_rows('heroes', None,
+                              {'name': ['Hector', 'Achilles'], 'age': [20, 19]})
+
+        Args:
+            table: str name of the table
+            columns: sequence of column names, in the same order as the values
+                of each row. Ignored if rows is a dictionary.
+            rows: one of
+                * a list of tuples (or lists) of values,
+                * an iterator or generator of tuples, which is consumed lazily
+                  if commit_each_chunk is set,
+                * a dictionary of column name to list of values, all the same
+                  length.
+            on_duplicate_key_update: tuple of the fields to update in the
+                existing row if there's a duplicate key error.
+            chunk_rows: int, max rows per statement, default
+                self.insert_chunk_rows.
+            chunk_bytes: int, approximate max bytes of values per statement,
+                default self.insert_chunk_bytes.
+            commit_each_chunk: bool, default False, meaning all chunks are
+                committed together as one transaction. If True, each chunk is
+                committed as soon as it's inserted, and a retry after a lost
+                connection only resends the chunk that failed.
+
+        Returns: list of dictionaries, one per chunk, with keys 'rows',
+            'affected', 'estimated_bytes' and 'seconds'.
+        """
+        if isinstance(rows, dict):
+            columns = sorted(rows.keys())
+            lengths = set(len(rows[c]) for c in columns)
+            if len(lengths) > 1:
+                raise Exception("Columns have different lengths: {}.".format(
+                    {c: len(rows[c]) for c in columns}))
+            rows = zip(*[rows[c] for c in columns])
+
+        return self._insert_chunks(
+            table, list(columns), rows,
+            on_duplicate_key_update=on_duplicate_key_update,
+            chunk_rows=chunk_rows, chunk_bytes=chunk_bytes,
+            commit_each_chunk=commit_each_chunk,
+        )
+
+    def _insert_query_string(self, table, columns, num_rows,
+                             on_duplicate_key_update=None):
+        """Multi-row INSERT with placeholders for num_rows rows."""
+        odku = tuple(on_duplicate_key_update or ())
+        return self.statement_cache.get(
+            ('insert', table, tuple(columns), num_rows, odku),
+            self._build_insert_query_string, table, columns, num_rows, odku,
+        )
+
+    @staticmethod
+    def _build_insert_query_string(table, columns, num_rows,
+                                   on_duplicate_key_update):
         # Backticks critical for avoiding collisions with MySQL reserved words,
         # e.g. 'condition'!
-        query_string = 'INSERT INTO `{}` (`{}`) VALUES ({})'.format(
+        row_placeholder = '({})'.format(', '.join(['%s'] * len(columns)))
+        query_string = 'INSERT INTO `{}` (`{}`) VALUES {}'.format(
             table,
-            '`, `'.join(correct_keys),
-            ', '.join(['%s'] * len(correct_keys)),
+            '`, `'.join(columns),
+            ','.join([row_placeholder] * num_rows),
         )
 
-        # MySQLdb expects a tuple or a list of tuples for the values.
-        value_tuples = [tuple(row.values()) for row in ordered_rows]
-        if len(row_dicts) is 1:
-            insert_method = 'execute'
-            params = value_tuples[0]
-        else:
-            insert_method = 'executemany'
-            params = value_tuples
-
         if on_duplicate_key_update:
             # Add the extra query syntax. This tells MySQL: when you encounter
             # an inserted row that would result in a duplicate key, instead do
@@ -281,32 +3022,525 @@ class MySQLApi(object):
                 )
             )
 
-        self._cursor_retry_wrapper(insert_method, query_string, params)
+        return query_string
 
-        self._commit()
+    @staticmethod
+    def _chunk_rows(value_tuples, num_columns, chunk_rows, chunk_bytes):
+        """Split value tuples into lists bounded by row count and size.
+
+        Raises if any row doesn't have num_columns values, since once the
+        values are flattened into one statement a short row would silently
+        shift every value after it.
+
+        Returns: generator of (rows, estimated bytes) pairs.
+        """
+        chunk = []
+        size = 0
+        for row in value_tuples:
+            if len(row) != num_columns:
+                raise Exception("Expected {} values, got: {}.".format(
+                    num_columns, row))
+            row_size = _estimate_row_bytes(row)
+            if chunk and (len(chunk) >= chunk_rows or
+                          size + row_size > chunk_bytes):
+                yield chunk, size
+                chunk = []
+                size = 0
+            chunk.append(row)
+            size += row_size
+        if chunk:
+            yield chunk, size
+
+    def _insert_chunks(self, table, columns, value_tuples,
+                       on_duplicate_key_update=None, chunk_rows=None,
+                       chunk_bytes=None, commit_each_chunk=False):
+        """Insert value tuples in chunks; see insert_rows()."""
+        def statement(rows):
+            query_string = self._insert_query_string(
+                table, columns, len(rows), on_duplicate_key_update)
+            return query_string, tuple(itertools.chain.from_iterable(rows))
+
+        return self._write_chunks(table, value_tuples, len(columns),
+                                  statement, chunk_rows, chunk_bytes,
+                                  commit_each_chunk)
+
+    def _write_chunks(self, table, value_tuples, num_columns, statement,
+                      chunk_rows=None, chunk_bytes=None,
+                      commit_each_chunk=False):
+        """Run one write statement per chunk of value tuples.
+
+        Args:
+            table: str name of the table written, for cache invalidation.
+            value_tuples: iterable of tuples, num_columns long.
+            statement: function taking a list of value tuples and returning
+                a (query_string, param_tuple) pair to write them.
+            chunk_rows, chunk_bytes, commit_each_chunk: see insert_rows().
+
+        Returns: list of dictionaries, one per chunk, with keys 'rows',
+            'affected', 'estimated_bytes' and 'seconds'.
+        """
+        chunks = self._chunk_rows(
+            value_tuples,
+            num_columns,
+            chunk_rows or self.insert_chunk_rows,
+            chunk_bytes or self.insert_chunk_bytes,
+        )
+        if not commit_each_chunk:
+            # Keep every chunk in case the transaction has to be resent.
+            chunks = list(chunks)
+
+        try:
+            return self._send_chunks(chunks, statement, commit_each_chunk)
+        except Exception:
+            if not commit_each_chunk and not self.transaction_depth:
+                # Earlier chunks are still uncommitted on this connection;
+                # don't let the next write commit them.
+                self._rollback()
+            raise
+        finally:
+            # Even on failure, earlier chunks may have been committed.
+            self._invalidate_results([table])
+
+    def _send_chunks(self, chunks, statement, commit_each_chunk):
+        """Send already-chunked rows; see _write_chunks()."""
+        stats = []
+        steps = self._chunk_write_steps(chunks, statement, commit_each_chunk,
+                                        self.retry_policy.num_tries, stats)
+        result = None
+        while True:
+            try:
+                action, arg = steps.send(result)
+            except StopIteration:
+                return stats
+            result = None
+            if action == 'execute':
+                self._cursor_execute(*arg)
+                result = (self.cursor.rowcount, self.connection)
+            elif action == 'commit':
+                self._commit()
+            else:
+                self.connection.rollback()
+
+    @staticmethod
+    def _chunk_write_steps(chunks, statement, commit_each_chunk, num_tries,
+                           stats):
+        """The steps of sending chunks, without the I/O.
+
+        Shared by MySQLApi and AsyncMySQLApi, which each run the steps with
+        their own driver. Yields (action, arg) pairs, and expects back:
+            ('execute', (query_string, param_tuple)): a pair of the rows
+                affected and the connection the statement ran on.
+            ('commit', None), ('rollback', None): None.
+
+        Args:
+            chunks: list of (rows, estimated bytes) pairs, see _chunk_rows().
+            statement, commit_each_chunk: see _write_chunks().
+            num_tries: int, times to send the chunks if the connection keeps
+                dropping mid-write.
+            stats: list, filled in with one dictionary per chunk, see
+                _write_chunks().
+        """
+        tries = 0
+        while True:
+            del stats[:]
+            connection = None
+            for rows, size in chunks:
+                start = time.time()
+                affected, used = yield 'execute', statement(rows)
+                if commit_each_chunk:
+                    yield 'commit', None
+                elif used is not connection:
+                    if stats:
+                        # The retry wrapper reconnected, so the uncommitted
+                        # chunks sent before this one were rolled back with
+                        # the old connection. Start the transaction over.
+                        yield 'rollback', None
+                        break
+                    connection = used
+                stats.append({
+                    'rows': len(rows),
+                    'affected': affected,
+                    'estimated_bytes': size,
+                    'seconds': time.time() - start,
+                })
+            else:
+                break  # all chunks sent
+            tries += 1
+            if tries >= num_tries:
+                raise Exception("Connection kept dropping mid-write, gave up.")
+            logging.error("Reconnected mid-write, resending all {} chunks."
+                          .format(len(chunks)))
+
+        if not commit_each_chunk:
+            yield 'commit', None
 
     def update_row(self, table, id_col, id, **params):
         """UPDATE a row by id, assumed to be unique key."""
-        query_string = 'UPDATE `{}` SET {} WHERE `{}` = %s'.format(
-            table,
-            ', '.join(['`{}` = %s'.format(k) for k in params.keys()]),
-            id_col,
+        keys = tuple(params.keys())
+        query_string = self.statement_cache.get(
+            ('update', table, keys, id_col),
+            self._build_update_row, table, keys, id_col,
         )
 
-        p = params.values()
+        p = [params[k] for k in keys]
         p.append(id)
 
         self.query(query_string, param_tuple=tuple(p))
 
         self._commit()
+        self._invalidate_results([table])
 
-    def delete_row(self, table, id_col, id):
-        """DELETE a row by id, assumed to be the unique key."""
-        query_string = 'DELETE FROM `{}` WHERE `{}` = %s'.format(
+    @staticmethod
+    def _build_update_row(table, keys, id_col):
+        return 'UPDATE `{}` SET {} WHERE `{}` = %s'.format(
             table,
+            ', '.join(['`{}` = %s'.format(k) for k in keys]),
             id_col,
         )
 
+    def delete_row(self, table, id_col, id):
+        """DELETE a row by id, assumed to be the unique key."""
+        query_string = self.statement_cache.get(
+            ('delete', table, id_col),
+            self._build_delete_row, table, id_col,
+        )
+
         self.query(query_string, param_tuple=(id,))
 
         self._commit()
+        self._invalidate_results([table])
+
+    @staticmethod
+    def _build_delete_row(table, id_col):
+        return 'DELETE FROM `{}` WHERE `{}` = %s'.format(table, id_col)
+
+    def update_rows(self, table, id_col, row_dicts, method='case',
+                    **kwargs):
+        """UPDATE many rows by id in a few statements.
+
+        Each row dictionary has the id_col value plus the fields to set; all
+        must have the same fields.
+
+        Args:
+            table: str name of the table
+            id_col: str, column that uniquely identifies rows.
+            row_dicts: list of dictionaries.
+            method: str, either
+                'case' (default): UPDATE ... SET `a` = CASE `id` WHEN ...
+                    WHERE `id` IN (...). Ids that don't exist are ignored.
+                'upsert': INSERT ... ON DUPLICATE KEY UPDATE. Usually faster,
+                    but ids that don't exist are inserted as new rows, and
+                    the insert must be valid on its own, i.e. any other NOT
+                    NULL columns need defaults.
+            kwargs: chunk_rows, chunk_bytes, commit_each_chunk; see
+                insert_rows().
+
+        Returns: list of dictionaries, one per chunk; see insert_rows().
+        """
+        if not row_dicts:
+            return []
+
+        columns = sorted(k for k in row_dicts[0].keys() if k != id_col)
+        num_columns = len(columns) + 1
+        value_tuples = _row_tuples(row_dicts, [id_col] + columns)
+
+        if method == 'upsert':
+            return self.insert_rows(table, [id_col] + columns, value_tuples,
+                                    on_duplicate_key_update=columns, **kwargs)
+        elif method != 'case':
+            raise Exception("Unknown update method: {}.".format(method))
+
+        def statement(rows):
+            query_string = self.statement_cache.get(
+                ('update_rows', table, id_col, tuple(columns), len(rows)),
+                self._build_update_rows, table, id_col, columns, len(rows),
+            )
+            params = []
+            for i in range(len(columns)):
+                for row in rows:
+                    params.append(row[0])
+                    params.append(row[i + 1])
+            params.extend([row[0] for row in rows])
+            return query_string, tuple(params)
+
+        return self._write_chunks(table, value_tuples, num_columns,
+                                  statement, **kwargs)
+
+    @staticmethod
+    def _build_update_rows(table, id_col, columns, num_rows):
+        case = 'CASE `{}` {} END'.format(
+            id_col, ' '.join(['WHEN %s THEN %s'] * num_rows))
+        return 'UPDATE `{}` SET {} WHERE `{}` IN ({})'.format(
+            table,
+            ', '.join(['`{}` = {}'.format(c, case) for c in columns]),
+            id_col,
+            ', '.join(['%s'] * num_rows),
+        )
+
+    def delete_rows(self, table, id_col, ids, **kwargs):
+        """DELETE many rows by id with chunked IN (...) lists.
+
+        Args:
+            table: str name of the table
+            id_col: str, column to match ids against.
+            ids: list of values of id_col.
+            kwargs: chunk_rows, chunk_bytes, commit_each_chunk; see
+                insert_rows().
+
+        Returns: list of dictionaries, one per chunk; see insert_rows().
+        """
+        def statement(rows):
+            query_string = self.statement_cache.get(
+                ('delete_rows', table, id_col, len(rows)),
+                self._build_delete_rows, table, id_col, len(rows),
+            )
+            return query_string, tuple([row[0] for row in rows])
+
+        return self._write_chunks(table, ((id,) for id in ids), 1,
+                                  statement, **kwargs)
+
+    @staticmethod
+    def _build_delete_rows(table, id_col, num_rows):
+        return 'DELETE FROM `{}` WHERE `{}` IN ({})'.format(
+            table, id_col, ', '.join(['%s'] * num_rows))
+
+    def sync_rows(self, table, key_cols, rows, method='diff',
+                  hash_col='row_hash', **kwargs):
+        """Make rows in a table match the given ones, writing only changes.
+
+        insert_row_dicts(..., on_duplicate_key_update=...) rewrites every
+        row, churning indexes and the binlog for rows that are already
+        up to date. This reads what's stored first, by key in chunks, and
+        then only inserts new rows and updates changed ones. Rows in the table
+        that aren't given are left alone.
+
+        Not atomic: a row changed by someone else between the read and the
+        write may be overwritten, or left as they changed it.
+
+        Args:
+            table: str name of the table
+            key_cols: str or sequence of str, the column(s) of a unique key.
+            rows: list of dictionaries, all with the same keys, which include
+                key_cols.
+            method: str, either
+                'diff' (default): read the stored values of every given
+                    column and compare them in Python.
+                'hash': read only an md5 of each row's other values, kept in
+                    hash_col and written along with the row. Much less to
+                    read for wide rows, but rows last written some other way
+                    always count as changed.
+            hash_col: str, name of a CHAR(32) column, for the 'hash' method.
+            kwargs: chunk_rows, chunk_bytes, commit_each_chunk; see
+                insert_rows(). Reads are chunked the same way.
+
+        Returns: dictionary with keys 'inserted', 'updated' and 'unchanged',
+            counts of rows, and 'chunks', the stats of the writes (see
+            insert_rows()).
+        """
+        if isinstance(key_cols, _string_types):
+            key_cols = (key_cols,)
+        key_cols = tuple(key_cols)
+        result = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'chunks': []}
+        if not rows:
+            return result
+
+        value_cols = sorted(k for k in rows[0].keys() if k not in key_cols)
+        if method == 'hash':
+            value_cols = [c for c in value_cols if c != hash_col]
+            read_cols = [hash_col]
+        elif method == 'diff':
+            read_cols = value_cols
+        else:
+            raise Exception("Unknown sync method: {}.".format(method))
+
+        columns = list(key_cols) + value_cols
+        num_keys = len(key_cols)
+        value_tuples = _row_tuples(rows, columns, num_fields=len(rows[0]))
+
+        # By _sync_key(), so keys match stored ones MySQL hands back in
+        # another form, and keys MySQL would see as the same clash here.
+        given = collections.OrderedDict()
+        for row in value_tuples:
+            key = _sync_key(row[:num_keys])
+            if key in given:
+                raise Exception("Duplicate key in rows: {}.".format(
+                    row[:num_keys]))
+            given[key] = row
+
+        # What's stored now, by key. Read from the primary: a lagging replica
+        # could return old values equal to the new ones, and the rows would
+        # never be written.
+        if self.replicas:
+            self.read_primary = True
+        stored = {}
+        read_chunks = self._chunk_rows(
+            [row[:num_keys] for row in given.values()],
+            num_keys,
+            kwargs.get('chunk_rows') or self.insert_chunk_rows,
+            kwargs.get('chunk_bytes') or self.insert_chunk_bytes,
+        )
+        for keys, size in read_chunks:
+            query_string = self.statement_cache.get(
+                ('sync_rows', table, key_cols, tuple(read_cols), len(keys)),
+                self._build_sync_select, table, key_cols, read_cols,
+                len(keys),
+            )
+            params = tuple(itertools.chain.from_iterable(keys))
+            for row in self.query(query_string, params):
+                stored[_sync_key(row[:num_keys])] = row[num_keys:]
+
+        to_write = []
+        for key, row in given.items():
+            if method == 'hash':
+                row += (_row_hash(row[num_keys:]),)
+            if key not in stored:
+                result['inserted'] += 1
+            elif method == 'hash' and stored[key][0] == row[-1]:
+                result['unchanged'] += 1
+                continue
+            elif method == 'diff' and all([
+                    _same_value(s, g)
+                    for s, g in zip(stored[key], row[num_keys:])]):
+                result['unchanged'] += 1
+                continue
+            else:
+                result['updated'] += 1
+            to_write.append(row)
+
+        if to_write:
+            if method == 'hash':
+                columns.append(hash_col)
+            # One upsert covers both new and changed rows.
+            result['chunks'] = self.insert_rows(
+                table, columns, to_write,
+                on_duplicate_key_update=columns[num_keys:], **kwargs)
+
+        return result
+
+    @staticmethod
+    def _build_sync_select(table, key_cols, read_cols, num_rows):
+        if len(key_cols) == 1:
+            where = '`{}` IN ({})'.format(
+                key_cols[0], ', '.join(['%s'] * num_rows))
+        else:
+            row_placeholder = '({})'.format(', '.join(['%s'] * len(key_cols)))
+            where = '(`{}`) IN ({})'.format(
+                '`, `'.join(key_cols),
+                ', '.join([row_placeholder] * num_rows),
+            )
+        return 'SELECT `{}` FROM `{}` WHERE {}'.format(
+            '`, `'.join(list(key_cols) + list(read_cols)), table, where)
+
+    def bulk_load(self, table, columns, rows_or_path,
+                  on_duplicate_key_update=None, duplicates=None):
+        """Load many rows with LOAD DATA LOCAL INFILE, MySQL's bulk loader.
+
+        Much faster than INSERT for millions of rows. Rows are streamed into
+        a temporary file in MySQL's default tab-separated format, which the
+        client then sends to the server.
+
+        Runs on a separate connection with LOCAL INFILE enabled, so it's not
+        part of any open transaction(); it commits when done.
+
+        Args:
+            table: str name of the table
+            columns: sequence of column names, in the order of each row.
+            rows_or_path: an iterable of tuples of values, or the str path of
+                a file already in MySQL's tab-separated format (fields
+                separated by tabs, lines by newlines, backslash escapes, \\N
+                for NULL).
+            on_duplicate_key_update: tuple of fields to update in existing
+                rows with a duplicate key. Rows are loaded into a temporary
+                staging table first, then copied with INSERT ... SELECT ...
+                ON DUPLICATE KEY UPDATE.
+            duplicates: str, 'ignore' or 'replace', what MySQL should do with
+                rows with a duplicate key, if not on_duplicate_key_update. By
+                default LOCAL loads skip them, with a warning.
+
+        Returns: dictionary with keys
+            'rows': int, rows read from the file,
+            'loaded': int, rows affected in the table (with
+                on_duplicate_key_update, MySQL counts an updated row as 2),
+            'skipped': int, rows skipped, e.g. as duplicates,
+            'warnings': int,
+            'seconds': float,
+            'rows_per_s': float.
+        """
+        if duplicates not in (None, 'ignore', 'replace'):
+            raise Exception("Unknown duplicates option: {}.".format(
+                duplicates))
+
+        start = time.time()
+        if self.replicas:
+            # Replicas may not have these rows yet, so read our own writes
+            # from here on, as after any other write.
+            self.read_primary = True
+        connection = MySQLdb.connect(charset='utf8', local_infile=1,
+                                     **self._credentials())
+        cursor = connection.cursor()
+        path = None
+        try:
+            if isinstance(rows_or_path, _string_types):
+                path = rows_or_path
+                temp_path = None
+            else:
+                path = temp_path = _write_tsv(rows_or_path, len(columns))
+
+            if on_duplicate_key_update:
+                load_table = '{}_bulk_load_{}'.format(table, os.getpid())
+                cursor.execute(
+                    'CREATE TEMPORARY TABLE `{}` LIKE `{}`'.format(
+                        load_table, table))
+            else:
+                load_table = table
+
+            column_list = '`{}`'.format('`, `'.join(columns))
+            load_query = """
+                LOAD DATA LOCAL INFILE %s
+                {duplicates}
+                INTO TABLE `{table}`
+                CHARACTER SET utf8
+                FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'
+                LINES TERMINATED BY '\\n'
+                ({columns})
+            """.format(
+                duplicates=(duplicates or '').upper(),
+                table=load_table,
+                columns=column_list,
+            )
+            cursor.execute(load_query, (path,))
+            stats = _parse_load_info(connection.info(), cursor.rowcount)
+            stats['warnings'] = connection.warning_count()
+
+            if on_duplicate_key_update:
+                cursor.execute(
+                    'INSERT INTO `{table}` ({columns}) '
+                    'SELECT {columns} FROM `{load_table}` '
+                    'ON DUPLICATE KEY UPDATE {updates}'.format(
+                        table=table,
+                        columns=column_list,
+                        load_table=load_table,
+                        updates=', '.join(
+                            ['`{field}` = VALUES(`{field}`)'.format(field=f)
+                             for f in on_duplicate_key_update]),
+                    ))
+                stats['loaded'] = cursor.rowcount
+                stats['warnings'] += connection.warning_count()
+                cursor.execute('DROP TEMPORARY TABLE `{}`'.format(load_table))
+
+            connection.commit()
+        except MySQLdb.Error:
+            connection.rollback()
+            raise
+        finally:
+            if path is not None and path is temp_path:
+                os.remove(temp_path)
+            self._close_cursor(cursor)
+            connection.close()
+            self._invalidate_results([table])
+
+        stats['seconds'] = time.time() - start
+        stats['rows_per_s'] = stats['rows'] / max(stats['seconds'], 1e-6)
+        self._record_stats('query', load_query, start, tries=1,
+                           rows=stats['loaded'])
+        return stats
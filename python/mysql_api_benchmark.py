@@ -0,0 +1,324 @@
+"""Benchmarks for MySQLApi hot paths, run against a local MySQL server.
+
+Prints results as JSON so runs before and after a change can be compared.
+
+Usage:
+
+    python mysql_api_benchmark.py --user root --password secret \
+        --db benchmark > before.json
+
+MySQLApi connects to local_ip/local_port when util.is_localhost() is true, so
+run this on a development machine. It creates, fills and finally drops a
+scratch table in the given database.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import mysql_api
+
+
+TABLE = 'mysql_api_benchmark'
+TABLE_DEFINITION = """
+    CREATE TABLE `{}` (
+        `id` INT UNSIGNED NOT NULL AUTO_INCREMENT,
+        `uid` VARCHAR(50) NOT NULL,
+        `name` VARCHAR(100) NOT NULL,
+        `score` DOUBLE NOT NULL,
+        `created` DATETIME NOT NULL,
+        PRIMARY KEY (`id`),
+        UNIQUE KEY `uid` (`uid`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+""".format(TABLE)
+
+
+def timed(function, repeat):
+    """Run function() repeat times.
+
+    Returns: dictionary of min, median and max seconds per run.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    times.sort()
+    return {
+        'min_s': times[0],
+        'median_s': times[len(times) // 2],
+        'max_s': times[-1],
+    }
+
+
+def make_rows(num_rows, start=0):
+    return [
+        {
+            'uid': 'uid_{}'.format(i),
+            'name': 'Benchmark Person {}'.format(i),
+            'score': i * 0.5,
+            'created': '2017-01-01 00:00:00',
+        }
+        for i in range(start, start + num_rows)
+    ]
+
+
+def reset_table(api):
+    api.query('DROP TABLE IF EXISTS `{}`'.format(TABLE))
+    api.query(TABLE_DEFINITION)
+    api.invalidate_schema([TABLE])
+
+
+def bench_insert(api, batch_sizes, total_rows, repeat):
+    """insert_row_dicts throughput by rows per call."""
+    results = []
+    for batch_size in batch_sizes:
+        rows = make_rows(total_rows)
+        batches = [rows[i:i + batch_size]
+                   for i in range(0, total_rows, batch_size)]
+
+        def run():
+            reset_table(api)
+            for batch in batches:
+                api.insert_row_dicts(TABLE, batch)
+
+        timing = timed(run, repeat)
+        results.append(dict(
+            timing,
+            name='insert_row_dicts',
+            batch_size=batch_size,
+            rows=total_rows,
+            rows_per_s=total_rows / timing['median_s'],
+        ))
+    return results
+
+
+def result_bytes(function):
+    """Bytes allocated and still held by what function() returns, or None
+    where tracemalloc isn't available (Python 2)."""
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    tracemalloc.start()
+    try:
+        result = function()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_select_conversion(api, num_rows, repeat):
+    """select_query result formats and converters, against query's tuples."""
+    from MySQLdb.constants import FIELD_TYPE
+
+    reset_table(api)
+    api.insert_row_dicts(TABLE, make_rows(num_rows))
+    query_string = 'SELECT * FROM `{}`'.format(TABLE)
+
+    cases = [('query', lambda: api.query(query_string))]
+    formats = ['dicts', 'tuples', 'rows', 'columns']
+    try:
+        import numpy  # noqa: F401
+        formats.append('arrays')
+    except ImportError:
+        pass
+    for result_format in formats:
+        cases.append((
+            'select_query_' + result_format,
+            lambda f=result_format: api.select_query(query_string,
+                                                     result_format=f),
+        ))
+    # Leave DATETIMEs as strings rather than building datetime objects.
+    cases.append((
+        'select_query_raw_datetimes',
+        lambda: api.select_query(query_string,
+                                 converters={FIELD_TYPE.DATETIME: None}),
+    ))
+
+    results = []
+    for name, function in cases:
+        timing = timed(function, repeat)
+        results.append(dict(
+            timing,
+            name=name,
+            rows=num_rows,
+            rows_per_s=num_rows / timing['median_s'],
+            result_bytes=result_bytes(function),
+        ))
+    return results
+
+
+def bench_pagination(api, num_rows, page_size, offsets, repeat):
+    """select_star_where page cost by offset, against keyset pages."""
+    reset_table(api)
+    api.insert_row_dicts(TABLE, make_rows(num_rows))
+
+    results = []
+    for offset in offsets:
+        timing = timed(
+            lambda: api.select_star_where(
+                TABLE, order_by='id', limit=page_size, offset=offset),
+            repeat)
+        results.append(dict(timing, name='select_star_where_offset',
+                            offset=offset, page_size=page_size))
+
+        # Same page via keyset pagination, starting after the row that the
+        # offset query skips to.
+        def keyset_page():
+            pages = api.iter_star_where(TABLE, 'id', page_size=page_size,
+                                        max_rows=page_size, after=(offset,))
+            list(pages)
+        timing = timed(keyset_page, repeat)
+        results.append(dict(timing, name='iter_star_where_keyset',
+                            offset=offset, page_size=page_size))
+    return results
+
+
+def bench_connect(config, repeat):
+    """Cost of a `with` block that runs one trivial query."""
+    results = []
+    for use_pool in (False, True):
+        def run():
+            with mysql_api.MySQLApi(**dict(config, use_pool=use_pool)) as api:
+                api.query('SELECT 1')
+        timing = timed(run, repeat)
+        results.append(dict(timing, name='connect', use_pool=use_pool))
+    return results
+
+
+def bench_retry(api, config, repeat):
+    """Overhead of the retry wrapper, and of recovering a lost connection."""
+    results = []
+
+    raw_cursor = api.connection.cursor()
+    timing = timed(lambda: raw_cursor.execute('SELECT 1'), repeat)
+    results.append(dict(timing, name='raw_cursor_execute'))
+
+    timing = timed(lambda: api.query('SELECT 1'), repeat)
+    results.append(dict(timing, name='retry_wrapper_execute'))
+
+    # Kill our own connection from another one, so the next query hits a
+    # lost connection and has to reconnect. Don't sleep between tries, to
+    # measure only the reconnect.
+    original_policy = api.retry_policy
+    api.retry_policy = mysql_api.RetryPolicy(base_delay_s=0)
+    try:
+        with mysql_api.MySQLApi(**config) as killer:
+            def run():
+                killer.query('KILL CONNECTION %s',
+                             (api.connection.thread_id(),))
+                api.query('SELECT 1')
+            timing = timed(run, repeat)
+    finally:
+        api.retry_policy = original_policy
+    results.append(dict(timing, name='lost_connection_retry'))
+
+    return results
+
+
+def time_import(statement):
+    """Seconds a fresh interpreter takes to run an import statement."""
+    code = ('import time; start = time.time(); {}; '
+            'print(time.time() - start)').format(statement)
+    output = subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(output.strip())
+
+
+def bench_startup(config, repeat):
+    """Cold start costs: importing, and entering a block that never queries.
+
+    Importing mysql_api defers importing MySQLdb and the App Engine APIs
+    until they're used, so importing MySQLdb itself shows the cost saved.
+    Likewise lazy_connect skips the connection of a `with` block that
+    doesn't query.
+    """
+    results = []
+    for name, statement in (('import_mysql_api', 'import mysql_api'),
+                            ('import_MySQLdb', 'import MySQLdb')):
+        times = sorted(time_import(statement) for _ in range(repeat))
+        results.append({
+            'name': name,
+            'min_s': times[0],
+            'median_s': times[len(times) // 2],
+            'max_s': times[-1],
+        })
+
+    for lazy_connect in (False, True):
+        def run():
+            with mysql_api.MySQLApi(
+                    **dict(config, lazy_connect=lazy_connect)):
+                pass
+        timing = timed(run, repeat)
+        results.append(dict(timing, name='enter_without_query',
+                            lazy_connect=lazy_connect))
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--rows', type=int, default=10000,
+                        help="rows to insert and select")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="runs of each benchmark, to take the median")
+    parser.add_argument('--output', default=None,
+                        help="file to write JSON to, default stdout")
+    args = parser.parse_args(argv)
+
+    config = {
+        'local_user': args.user,
+        'local_password': args.password,
+        'local_ip': args.host,
+        'local_port': args.port,
+        'db_name': args.db,
+    }
+
+    results = []
+    with mysql_api.MySQLApi(**config) as api:
+        mysql_version = api.select_single_value('SELECT VERSION()')
+        try:
+            results += bench_insert(api, [1, 10, 100, 1000], args.rows,
+                                    args.repeat)
+            results += bench_select_conversion(api, args.rows, args.repeat)
+            results += bench_pagination(
+                api, args.rows, 100,
+                [0, args.rows // 10, args.rows // 2, args.rows - 100],
+                args.repeat)
+            results += bench_connect(config, args.repeat * 10)
+            results += bench_retry(api, config, args.repeat)
+            results += bench_startup(config, args.repeat)
+        finally:
+            api.query('DROP TABLE IF EXISTS `{}`'.format(TABLE))
+
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'mysql': mysql_version,
+        'rows': args.rows,
+        'repeat': args.repeat,
+        'results': results,
+        'query_stats': mysql_api.MySQLApi.query_stats.summary(),
+    }
+    output = json.dumps(report, indent=2, sort_keys=True, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,304 @@
+"""Stream a query or table from MySQL to CSV or JSON lines, optionally gzipped.
+
+Memory stays flat however big the table: rows come from an unbuffered cursor
+a batch at a time and are written out as they arrive.
+
+Usage:
+
+    python mysql_export.py --user root --db mydb --table user \
+        --output user.csv.gz
+    python mysql_export.py --user root --db mydb --output teams.jsonl \
+        --query "SELECT * FROM team WHERE program_id = 'Program_ABC'"
+
+Big tables with an integer primary key can be read by several connections
+at once, each taking a range of keys, with --partitions.
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+
+import mysql_api
+
+
+PY2 = sys.version_info[0] == 2
+
+_integer_type_pattern = re.compile(r'(tiny|small|medium|big)?int\b',
+                                   re.IGNORECASE)
+
+
+def _open_output(path, compress):
+    """Open a file for writing text, the way csv/json expect per Python."""
+    if PY2:
+        # Python 2's csv and json write byte strings.
+        return gzip.open(path, 'wb') if compress else open(path, 'wb')
+    if compress:
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    return io.open(path, 'w', encoding='utf-8', newline='')
+
+
+def _text(value):
+    """Value as csv/json should see it: unicode text, or a number."""
+    if isinstance(value, (bytes, bytearray)) and not PY2:
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _json_default(value):
+    """Encode types json doesn't know, e.g. datetime and Decimal."""
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode('utf-8', 'replace')
+    return str(value)
+
+
+class _CsvWriter(object):
+    def __init__(self, f, fields, header):
+        self.writer = csv.writer(f)
+        if header:
+            self.writer.writerow(self._encode(fields))
+
+    def _encode(self, row):
+        if PY2:
+            return [v.encode('utf-8') if isinstance(v, unicode) else
+                    ('' if v is None else v) for v in row]
+        return ['' if v is None else _text(v) for v in row]
+
+    def write_rows(self, rows):
+        self.writer.writerows([self._encode(row) for row in rows])
+
+
+class _JsonLinesWriter(object):
+    def __init__(self, f, fields, header):
+        self.f = f
+        # Encode each key once, rather than once per row.
+        self.keys = [json.dumps(_text(k)) + ': ' for k in fields]
+
+    def write_rows(self, rows):
+        lines = []
+        for row in rows:
+            lines.append('{' + ', '.join([
+                k + json.dumps(_text(v), default=_json_default)
+                for k, v in zip(self.keys, row)
+            ]) + '}\n')
+        self.f.write(''.join(lines))
+
+
+def _format(path, format):
+    if format is not None:
+        return format
+    stem = path[:-3] if path.endswith('.gz') else path
+    return 'jsonl' if stem.endswith(('.jsonl', '.json')) else 'csv'
+
+
+def export_query(api, query_string, output_path, param_tuple=tuple(),
+                 format=None, compress=None, batch_size=1000, header=True):
+    """Write the results of a query to a file.
+
+    Args:
+        api: MySQLApi, which must not be used for anything else until this
+            returns.
+        query_string: str, a SELECT.
+        output_path: str, path to write to.
+        param_tuple: tuple, values for %s placeholders in query_string.
+        format: str, 'csv' or 'jsonl', default from the output_path
+            extension, e.g. 'out.jsonl.gz', otherwise csv. NULL is an empty
+            field in CSV.
+        compress: bool, gzip the output, default True if output_path ends in
+            '.gz'.
+        batch_size: int, rows fetched and written at a time.
+        header: bool, write column names as the first line of a CSV.
+
+    Returns: dictionary with keys 'rows', 'seconds', 'path'.
+    """
+    start = time.time()
+    format = _format(output_path, format)
+    if compress is None:
+        compress = output_path.endswith('.gz')
+    writer_class = {'csv': _CsvWriter, 'jsonl': _JsonLinesWriter}[format]
+
+    # With no parameters MySQLdb leaves the query alone; an empty tuple would
+    # still have it treat every % as a placeholder, e.g. in LIKE 'x%'.
+    batches = api.iter_query(query_string, param_tuple or None,
+                             batch_size=batch_size, batches=True, header=True)
+    num_rows = 0
+    try:
+        with _open_output(output_path, compress) as f:
+            writer = None
+            for batch in batches:
+                if writer is None:
+                    # First batch is the column names.
+                    writer = writer_class(f, batch[0], header)
+                    continue
+                writer.write_rows(batch)
+                num_rows += len(batch)
+    finally:
+        batches.close()
+
+    return {
+        'rows': num_rows,
+        'seconds': time.time() - start,
+        'path': output_path,
+    }
+
+
+def export_table(api, table, output_path, format=None, compress=None,
+                 batch_size=1000, partitions=1, key=None):
+    """Write a whole table to a file, optionally reading it in parallel.
+
+    Args:
+        api: MySQLApi
+        table: str name of the table
+        output_path, format, compress, batch_size: see export_query().
+        partitions: int, if more than 1, split the table into this many
+            ranges of `key` and read them on separate connections at the
+            same time, each into its own file, then join the files in order.
+        key: str, integer column to split on, default the table's primary
+            key, which must then be a single column. Rows where it's NULL
+            are read with the first range.
+
+    Returns: dictionary with keys 'rows', 'seconds', 'path'.
+    """
+    query_string = 'SELECT * FROM `{}`'.format(table)
+    if partitions <= 1:
+        return export_query(api, query_string, output_path, format=format,
+                            compress=compress, batch_size=batch_size)
+
+    start = time.time()
+    schema = api.table_schema(table)
+    if key is None:
+        primary_key = schema['primary_key']
+        if len(primary_key) != 1:
+            raise Exception("Table {} needs a single-column primary key to "
+                            "partition on; give a key.".format(table))
+        key = primary_key[0]
+    if key not in schema['types']:
+        raise Exception("Table {} has no column {}.".format(table, key))
+    if not _integer_type_pattern.match(schema['types'][key]):
+        raise Exception("Can only partition on an integer column, but {}.{} "
+                        "is {}; give another key.".format(
+                            table, key, schema['types'][key]))
+
+    low, high = api.query(
+        'SELECT MIN(`{key}`), MAX(`{key}`) FROM `{table}`'.format(
+            key=key, table=table))[0]
+    if low is None:
+        # Empty table.
+        return export_query(api, query_string, output_path, format=format,
+                            compress=compress, batch_size=batch_size)
+    step = (high - low) // partitions + 1
+
+    # Part files don't have the extension, so settle these from it now.
+    format = _format(output_path, format)
+    if compress is None:
+        compress = output_path.endswith('.gz')
+    config = api.config()
+    part_paths = ['{}.part{}'.format(output_path, i)
+                  for i in range(partitions)]
+    results = [None] * partitions
+    errors = [None] * partitions
+
+    def work(i):
+        where = '`{key}` >= %s AND `{key}` < %s'
+        if i == 0:
+            # Rows with a NULL key fall in no range; NULLs sort first, so
+            # they go at the start of the first part.
+            where = '({}) OR `{{key}}` IS NULL'.format(where)
+        try:
+            with mysql_api.MySQLApi(**config) as part_api:
+                results[i] = export_query(
+                    part_api,
+                    '{} WHERE {} ORDER BY `{}`'.format(
+                        query_string, where.format(key=key), key),
+                    part_paths[i],
+                    param_tuple=(low + i * step, low + (i + 1) * step),
+                    format=format,
+                    compress=compress,
+                    batch_size=batch_size,
+                    header=i == 0,  # only one header in the joined file
+                )
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=work, args=(i,))
+               for i in range(partitions)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    try:
+        for e in errors:
+            if e is not None:
+                raise e
+        # Concatenated gzip files are a valid gzip file, so whether or not
+        # they're compressed the parts can be joined byte for byte.
+        with open(output_path, 'wb') as f:
+            for path in part_paths:
+                with open(path, 'rb') as part:
+                    shutil.copyfileobj(part, f)
+    finally:
+        for path in part_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    return {
+        'rows': sum([r['rows'] for r in results]),
+        'seconds': time.time() - start,
+        'path': output_path,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--db', required=True)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--table')
+    source.add_argument('--query')
+    parser.add_argument('--output', required=True,
+                        help="file to write; .gz to compress")
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default=None,
+                        help="default from the --output extension")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--partitions', type=int, default=1,
+                        help="read a --table on this many connections")
+    parser.add_argument('--key', default=None,
+                        help="integer column to partition on, default the "
+                             "primary key")
+    args = parser.parse_args(argv)
+
+    config = {
+        'local_user': args.user,
+        'local_password': args.password,
+        'local_ip': args.host,
+        'local_port': args.port,
+        'db_name': args.db,
+    }
+    with mysql_api.MySQLApi(**config) as api:
+        if args.table:
+            result = export_table(
+                api, args.table, args.output, format=args.format,
+                batch_size=args.batch_size, partitions=args.partitions,
+                key=args.key)
+        else:
+            result = export_query(
+                api, args.query, args.output, format=args.format,
+                batch_size=args.batch_size)
+
+    sys.stderr.write("Wrote {rows} rows to {path} in {seconds:.1f}s.\n"
+                     .format(**result))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])